@@ -73,6 +73,10 @@ include $(wildcard *.d)
 
 # additional artifacts from .fountain
 
-# markdown plot summary
-.ftx.plot-summary:
-	$(XSLTPROC) -o $@ $(FOUNTAINHEADDIR)/plot-summary.xslt $<
+# markdown plot summary, straight from the source: same output as
+# plot-summary.xslt, without parsing action and dialogue. It keeps its
+# own list of includes, as writing $*.d too would race the .ftx rule
+# under make -j
+%.plot-summary : %.fountain %.plot-summary.d
+	$(PYTHON) $(FOUNTAINHEADDIR)/fountainhead.py -M $< > $@.d
+	$(PYTHON) $(FOUNTAINHEADDIR)/fountainhead.py -xp -m Version "$(GIT_VERSION)" $< > $@
@@ -9,6 +9,26 @@ import markdown.blockprocessors as bp
 import markdown.inlinepatterns as ip
 import argparse
 import os.path
+import unicodedata
+import io
+import json
+import hashlib
+import itertools
+import bisect
+import collections
+import difflib
+import sqlite3
+import csv
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import socket
+import multiprocessing
+import multiprocessing.pool
+import subprocess
+import mmap
 
 # fountain source element types
 TITLE_PAGE = "title-page"
@@ -30,38 +50,168 @@ PAGE_BREAK = "page-break"
 
 INCLUDE = "include"
 
-
-def parse_fountain(lines, args):
+# element types that projection (--only) can keep; structural
+# containers (section, scene, dialogue) remain regardless
+PROJECTABLE = (TITLE_PAGE, SCENE_HEADING, ACTION, CHARACTER, PARENTHETICAL, DIALOGUE,
+               TRANSITION, SYNOPSIS, PAGE_BREAK)
+# element types that delimit scenes and sections; projection keeps
+# them until structuring is done
+DELIMITERS = (SECTION_HEADING, SCENE_HEADING, TRANSITION, PAGE_BREAK, INCLUDE)
+
+def parse_fountain(lines, args, engine=None, hooks=None):
+    """Returns FTX of Fountain source lines. Inline formatting uses
+    engine if given, or else a fresh inline_engine(). Hooks, if given,
+    get the elements of the body as the passes of the parse make them;
+    those of includes they don't."""
+    return parse_document(lines, args, engine, hooks)
+
+def parse_document(lines, args, engine=None, hooks=None):
     doc=xml.dom.minidom.getDOMImplementation().createDocument(None, "fountain", None)
     if args.css:
         doc.insertBefore(doc.createProcessingInstruction("xml-stylesheet", "href='%s'" % args.css),
                          doc.documentElement)
-    lines=map(lambda l: unicode(l.rstrip("\r\n"), "utf-8"), lines)
+    keep=args.only and set(args.only)
+    if keep and not keep-set([TITLE_PAGE]):
+        # metadata only: no need to read past the title page
+        parse_title(read_title_page(lines), doc.documentElement, args.meta)
+        if not args.flat_output:
+            parse_inlines(doc, args.semantic_linebreaks, args.syntax_extensions, engine)
+        return doc
+    lines=decode_lines(lines)
     title, body = split_title_body(lines)
-    parse_title(title, doc.documentElement, args.meta)
+    if not keep or TITLE_PAGE in keep:
+        parse_title(title, doc.documentElement, args.meta)
     body, notes = parse_comments_notes(body)
-    pbody=parse_body(body, doc.documentElement, args.syntax_extensions)
-    if args.flat_output:
-        return doc
-    structure_dialogue(doc)
-    structure_scenes(doc)
-    structure_sections(doc)
-    parse_inlines(doc, args.semantic_linebreaks, args.syntax_extensions)
-    reconstitute_notes(doc, notes)
+    sources=args.digests and normalize_sources(body, notes)
+    if args.jobs>1 and not keep and not args.flat_output and not hooks:
+        # the title page, then the body in chunks on a process pool
+        parse_inlines(doc, args.semantic_linebreaks, args.syntax_extensions, engine)
+        parse_parallel(body, notes, sources, doc.documentElement, args)
+        structure_sections(doc)
+    else:
+        pbody=parse_body(body, doc.documentElement, args.syntax_extensions, keep, sources, hooks)
+        if args.flat_output:
+            if keep:
+                prune(doc, keep)
+            return doc
+        structure_dialogue(doc, hooks)
+        structure_scenes(doc, hooks)
+        structure_sections(doc, hooks)
+        if keep:
+            prune(doc, keep)
+        parse_inlines(doc, args.semantic_linebreaks, args.syntax_extensions, engine, hooks)
+        reconstitute_notes(doc, notes, hooks)
     if args.syntax_extensions:
-        process_includes(doc, args)
+        process_includes(doc, args, engine)
+    if args.digests:
+        add_digests(doc, args)
+    if args.paginate:
+        paginate(doc)
     return doc
 
+class Hooks(object):
+    """Callbacks for elements of FTX as the parse makes them, for
+    statistics and reports that would otherwise each walk the finished
+    tree. Each pass calls them for the elements it makes, in document
+    order: parse_body() for the elements of lines, once their text is
+    complete but before inline formatting; the structuring passes for
+    dialogue and dual-dialogue, scenes and sections, which open when
+    made and close once their content is in; inline formatting for bd
+    and note. Elements from an earlier pass inside one from a later
+    pass have had their callbacks by the time it opens. Elements get
+    callbacks by type, any number of them."""
+
+    def __init__(self):
+        # element type: (open callbacks, close callbacks)
+        self.callbacks={}
+
+    def add(self, tag, opened=None, closed=None):
+        """Calls opened(element) and closed(element) for elements of
+        type tag."""
+        opens, closes = self.callbacks.setdefault(tag, ([], []))
+        if opened:
+            opens.append(opened)
+        if closed:
+            closes.append(closed)
+
+    def add_visitor(self, visitor):
+        """Adds the open_type and close_type methods of visitor, where
+        type is the element type with _ for -, e.g. open_scene_heading."""
+        for name in dir(visitor):
+            for (prefix, kind) in (("open_", "opened"), ("close_", "closed")):
+                if name.startswith(prefix):
+                    self.add(name[len(prefix):].replace("_", "-"), **{kind: getattr(visitor, name)})
+
+    def __nonzero__(self):
+        return bool(self.callbacks)
+
+    def open(self, e):
+        for f in self.callbacks.get(e.tagName, ((), ()))[0]:
+            f(e)
+
+    def close(self, e):
+        for f in self.callbacks.get(e.tagName, ((), ()))[1]:
+            f(e)
+
+    def made(self, e):
+        """Opens and closes e, which is complete."""
+        self.open(e)
+        self.close(e)
+
+class Parser(object):
+    """Parses Fountain with options set once, for callers that parse
+    many scripts. A Parser keeps one inline engine per thread, so
+    threads can share it."""
+
+    def __init__(self, semantic_linebreaks=False, syntax_extensions=False,
+                 css=None, meta=None, digests=False, include_root=None):
+        self.args=parse_options().parse_args([])
+        self.args.semantic_linebreaks=semantic_linebreaks
+        self.args.syntax_extensions=syntax_extensions
+        self.args.css=css
+        self.args.meta=meta and list(meta)
+        self.args.digests=digests
+        self.include_root=include_root
+        self.local=threading.local()
+
+    def engine(self):
+        try:
+            return self.local.engine
+        except AttributeError:
+            self.local.engine=inline_engine(self.args.syntax_extensions)
+            return self.local.engine
+
+    def parse_lines(self, lines, filename=None, hooks=None):
+        """Parses UTF-8 encoded lines. Includes resolve relative to
+        filename if given, or else to the include root."""
+        if filename is None:
+            # process_includes() only needs the including file's
+            # name, and a trailing separator makes the root its directory
+            filename=os.path.join(self.include_root or os.curdir, "")
+        infile=argparse.Namespace(name=filename)
+        return parse_fountain(lines, updated_args(self.args, infile=infile), self.engine(), hooks)
+
+    def parse_string(self, text, filename=None, hooks=None):
+        if isinstance(text, unicode):
+            text=text.encode("utf-8")
+        return self.parse_lines(io.BytesIO(text), filename, hooks)
+
+    def parse_file(self, filename, hooks=None):
+        with open(filename) as f:
+            return self.parse_lines(f, filename, hooks)
+
+def decode_line(l):
+    return unicode(l.rstrip("\r\n"), "utf-8")
+
+def decode_lines(lines):
+    return map(decode_line, lines)
+
 def split_title_body(lines):
     lines=discard_leading_empty_lines(lines)
     if not len(lines):
         # nothing at all
         return ((),())
-    if (lines[0]!=lines[0].lstrip()) or \
-       (not ":" in lines[0]) or \
-       (re.search(r"[^\w ]", lines[0].split(":")[0])) or \
-       (lines[0].strip().upper()=="FADE IN:") or \
-       (lines[0].strip().upper().endswith(" TO:")):
+    if not starts_title_page(lines[0]):
         # no title page
         return ((),lines)
     # title page present, need to find where it ends
@@ -71,6 +221,28 @@ def split_title_body(lines):
     # title page only
     return (lines, ())
 
+def starts_title_page(line):
+    return not ((line!=line.lstrip()) or
+                (not ":" in line) or
+                (re.search(r"[^\w ]", line.split(":")[0])) or
+                (line.strip().upper()=="FADE IN:") or
+                (line.strip().upper().endswith(" TO:")))
+
+def read_title_page(lines):
+    """Returns the decoded title page lines, reading (undecoded) lines
+    only as far as the end of the title page."""
+    title=[]
+    for l in lines:
+        l=decode_line(l)
+        if not l:
+            if title:
+                break
+        elif title or starts_title_page(l):
+            title.append(l)
+        else:
+            break
+    return title
+
 def discard_leading_empty_lines(lines):
     for n, l in enumerate(lines):
         if l:
@@ -110,58 +282,132 @@ def parse_title(lines, fountain, extra_keys):
 def parse_comments_notes(lines):
     text="\n".join(lines)
     text=re.sub(r"(/\*.*?\*/)", "", text, flags=re.DOTALL)
-    out_text=""
+    out_text=[]
     notes=[]
     for token in re.split(r"(\[\[.*?\]\])", text, flags=re.DOTALL):
         if token.startswith("[[") and token.endswith("]]"):
-            out_text+="[["+str(len(notes))+"]]"
-            notes+=[token[2:-2]]
+            out_text.append("[["+str(len(notes))+"]]")
+            notes.append(token[2:-2])
         else:
-            out_text+=token
-    return out_text.split("\n"), notes
+            out_text.append(token)
+    # unicode even when there's no body to decode
+    return u"".join(out_text).split(u"\n"), notes
 
 # Parsing lines of text into text-only elements
 
-def parse_body(lines, fountain, syntax_extensions):
+def parse_body(lines, fountain, syntax_extensions, keep=None, sources=None, hooks=None):
+    # with projection, lines of other types still take part in
+    # classification, but never make it into the tree; delimiters
+    # remain until structuring is done, and dialogue needs its
+    # character
+    if keep:
+        keep=keep.union(DELIMITERS)
+        if keep.intersection((PARENTHETICAL, DIALOGUE)):
+            keep.add(CHARACTER)
+    last_tag=None
+    # elements before done have been to hooks; the last one can still
+    # get more lines, or go if it's an empty action
+    done=len(fountain.childNodes)
+    for n, (tag, text, extra) in enumerate(classify_lines(lines, syntax_extensions)):
+        if not keep or tag in keep:
+            e=push_line(fountain, tag, text, extra, tag==last_tag)
+            if sources:
+                remember_source(e, sources[n])
+        else:
+            end_element(fountain)
+        last_tag=tag
+        if hooks:
+            for e in fountain.childNodes[done:-1]:
+                hooks.made(e)
+            done=max(done, len(fountain.childNodes)-1)
+    if hooks:
+        for e in fountain.childNodes[done:]:
+            hooks.made(e)
+
+def remember_source(e, line):
+    # each element remembers the source lines it came from
+    if not hasattr(e, "source_lines"):
+        e.source_lines=[]
+    e.source_lines.append(line)
+
+# tags after which the next line counts as preceded by an empty line
+EMPTY_LINE_AFTER = (
+    TITLE_PAGE, PAGE_BREAK, # first line on a page has no preceding line
+    SYNOPSIS, SECTION_HEADING, # removing these leaves empty lines
+    SCENE_HEADING, TRANSITION # require empty line in source, imply one in tree
+)
+
+# tags that continue a dialogue block
+DIALOGUE_CONTEXT = (CHARACTER, EXTENSION, PARENTHETICAL, DIALOGUE)
+
+# patterns classification matches, compiled once rather than looked
+# up in the re module's cache for each line
+SECTION_MARKER = re.compile(r"(#{1,6})")
+PAGE_BREAK_LINE = re.compile(r"^===+$")
+SCENE_TOKEN_END = re.compile(r"[\. ]")
+NOT_WORD = re.compile(r"\W", re.U)
+DIGIT_OR_UNDERSCORE = re.compile(r"[0-9_]")
+IN_PARENTHESES = re.compile(r"^\(.*\)$")
+
+# scene heading tokens, upper case
+SCENE_TOKENS = frozenset(("INT", "EXT", "EST", "INT/EXT", "I/E"))
+
+def classify_lines(lines, syntax_extensions):
+    """Generates a (tag, text, extra) tuple for each line of body
+    text. The classification needs no document tree: lookback depends
+    only on the tag and text of the previous line."""
     # this loop is a little awkward; it must accommodate fountain
     # requirements for lookback and lookahead ("A Scene Heading is any
-    # line that has a blank line following it")
-    if not len(lines):
-        return
-    line = lines[0]
-    for nextline in lines[1:]:
-        parse_line(line, fountain, nextline, syntax_extensions)
-        line=nextline
-    parse_line(line, fountain, None, syntax_extensions)
-
-def parse_line(line, fountain, nextline, syntax_extensions):
-    sline = line.strip()
-    
+    # line that has a blank line following it"). Features of lines
+    # that don't depend on context come first, in one pass, so
+    # lookahead is a lookup
+    stripped=[l.strip() for l in lines]
+    # whether each line is empty, and then the end of input
+    empty=bytearray(not l for l in lines)+"\1"
+    last_tag=None
+    last_empty=True
+    for n, line in enumerate(lines):
+        tag, text, extra = classify_features(line, stripped[n], empty[n+1], last_tag, last_empty,
+                                             syntax_extensions)
+        # multi-line elements accumulate text; an empty line leaves
+        # the accumulated text empty or ending in a linefeed
+        last_tag=tag
+        last_empty=tag in EMPTY_LINE_AFTER or not text
+        yield tag, text, extra
+
+def classify_line(line, nextline, last_tag, last_empty, syntax_extensions):
+    return classify_features(line, line.strip(), not nextline, last_tag, last_empty, syntax_extensions)
+
+def classify_features(line, sline, next_empty, last_tag, last_empty, syntax_extensions):
+    # sline is the line stripped; next_empty, whether the next line is
+    # empty or there is none
+    first=sline[:1]
+
     # first, I consider forcing elements
-    if line.lstrip().startswith("!"):
-        return push_element(fountain, ACTION, line.lstrip()[1:])
+    if first=="!":
+        return ACTION, line.lstrip()[1:], None
 
     # next, I handle context-free elements
-    if sline.startswith("#"):
+    if first=="#":
         # "If there are capturing groups in the separator and it
         # matches at the start of the string, the result will start
         # with an empty string."
-        _,marker,text=re.split(r"(#{1,6})", sline, maxsplit=1)
-        return push_section_heading(fountain, len(marker), text.strip())
-    # page breaks may look like synopses, so I process them first
-    if re.match(r"^===+$", sline):
-        return push_element(fountain, PAGE_BREAK, "")
-    # FountainHead extensions piggyback on synopsis
-    if syntax_extensions:
-        if sline.startswith("=<"):
-            return push_element(fountain, INCLUDE, sline[2:])
-    # regular synopsis
-    if sline.startswith("="):
-        return push_element(fountain, SYNOPSIS, sline[1:].lstrip())
+        _,marker,text=SECTION_MARKER.split(sline, maxsplit=1)
+        return SECTION_HEADING, text.strip(), len(marker)
+    if first=="=":
+        # page breaks may look like synopses, so I process them first
+        if PAGE_BREAK_LINE.match(sline):
+            return PAGE_BREAK, "", None
+        # FountainHead extensions piggyback on synopsis
+        if syntax_extensions:
+            if sline.startswith("=<"):
+                return INCLUDE, sline[2:], None
+        # regular synopsis
+        return SYNOPSIS, sline[1:].lstrip(), None
 
     # next, elements that require lookahead or lookback
-    if last_line_empty(fountain):
-        if not nextline:
+    if last_empty:
+        if next_empty:
             # "A Scene Heading is any line that has a blank line
             # following it, and either begins with INT or EXT or
             # similar (full list below). A Scene Heading always has at
@@ -170,33 +416,31 @@ def parse_line(line, fountain, nextline, syntax_extensions):
             # either a dot or a space, is considered a Scene Heading
             # (unless the line is preceded by an exclamation point
             # !). Case insensitive.  INT EXT EST INT./EXT INT/EXT I/E"
-            token = re.split(r"[\. ]", sline+" ")[0].upper()
-            if token in ("INT", "EXT", "EST", "INT/EXT", "I/E"):
-                return push_scene_heading(fountain,
-                                          sline[len(token)+1:].lstrip(),
-                                          setting=sline[:len(token)+1].rstrip())
+            token = SCENE_TOKEN_END.split(sline+" ", 1)[0].upper()
+            if token in SCENE_TOKENS:
+                return (SCENE_HEADING,
+                        sline[len(token)+1:].lstrip(),
+                        sline[:len(token)+1].rstrip())
             # "You can "force" a Scene Heading by starting the line
             # with a single period. Note that only a single leading
             # period followed by an alphanumeric character will force
             # a Scene Heading. This allows the writer to begin Action
             # and Dialogue elements with ellipses without worry that
             # they'll be interpreted as Scene Headings."
-            if sline.startswith(".") and not sline.startswith(".."):
-                return push_scene_heading(fountain, sline[1:].lstrip())
+            if first=="." and not sline.startswith(".."):
+                return SCENE_HEADING, sline[1:].lstrip(), None
 
             # "The requirements for Transition elements are:
             # Uppercase; Preceded by and followed by an empty line;
             # Ending in TO:"
-            if line.upper()==line:
-                if line.endswith("TO:"):
-                    return push_element(fountain, TRANSITION, sline)
+            if line.endswith("TO:") and line.upper()==line:
+                return TRANSITION, sline, None
             # "You can force any line to be a transition by beginning
             # it with a greater-than symbol >."
-            if sline.startswith(">") and not sline.endswith("<"):
-                return push_element(fountain, TRANSITION, sline[1:].lstrip())
+            if first==">" and not sline.endswith("<"):
+                return TRANSITION, sline[1:].lstrip(), None
 
-    if last_line_empty(fountain):
-        if nextline:
+        else:
             # "A Character element is any line entirely in uppercase,
             # with one empty line before it and without an empty line
             # after it."
@@ -204,56 +448,54 @@ def parse_line(line, fountain, nextline, syntax_extensions):
                 # "Character names must include at least one
                 # alphabetical character. "R2D2" works, but "23" does
                 # not."
-                if re.sub(r"[0-9_]", "", re.sub(r"\W", "", line, flags=re.U)):
-                    return push_character(fountain, sline)
+                if DIGIT_OR_UNDERSCORE.sub("", NOT_WORD.sub("", line)):
+                    return CHARACTER, sline, None
             # "You can force a Character element by preceding it with
             # the "at" symbol @."
-            if sline.startswith("@"):
-                return push_character(fountain, sline[1:].lstrip())
+            if first=="@":
+                return CHARACTER, sline[1:].lstrip(), None
 
     # "Dialogue is any text following a Character or Parenthetical
     # element."
     # "Parentheticals follow a Character or Dialogue element, and are
     # wrapped in parentheses ()."
-    if line and fountain.hasChildNodes() and fountain.lastChild.nodeName in (CHARACTER, EXTENSION, PARENTHETICAL, DIALOGUE):
-        if re.match(r"^\(.*\)$", sline):
-            return push_element(fountain, PARENTHETICAL, sline)
+    if line and last_tag in DIALOGUE_CONTEXT:
+        if first=="(" and IN_PARENTHESES.match(sline):
+            return PARENTHETICAL, sline, None
         else:
-            return push_element(fountain, DIALOGUE, sline)
+            return DIALOGUE, sline, None
     
     # finally, "Action, or scene description, is any paragraph that
     # doesn't meet criteria for another element"
-    return push_element(fountain, ACTION, line)
-
-def last_line_empty(fountain):
-    # assuming fountain is a flat list of elements, each containing a
-    # single text node
-    if not fountain.hasChildNodes():
-        return True
-    elif fountain.lastChild.tagName in (
-            TITLE_PAGE, PAGE_BREAK, # first line on a page has no preceding line
-            SYNOPSIS, SECTION_HEADING, # removing these leaves empty lines
-            SCENE_HEADING, TRANSITION # require empty line in source, imply one in tree
-    ):
-        return True
-    else:
-        text=fountain.lastChild.lastChild.nodeValue
-        return (not len(text)) or text.endswith("\n")
-
-def push_element(fountain, tag, text):
-    if tag in (ACTION, DIALOGUE) and fountain.hasChildNodes() and fountain.lastChild.nodeName==tag:
+    return ACTION, line, None
+
+def push_line(fountain, tag, text, extra=None, continued=False):
+    if tag==SCENE_HEADING:
+        return push_scene_heading(fountain, text, setting=extra)
+    if tag==SECTION_HEADING:
+        return push_section_heading(fountain, extra, text)
+    if tag==CHARACTER:
+        return push_character(fountain, text)
+    return push_element(fountain, tag, text, continued)
+
+def push_element(fountain, tag, text, continued=False):
+    # continued: previous line was of the same type
+    if tag in (ACTION, DIALOGUE) and continued:
         # append line to multi-line elements
         fountain.lastChild.firstChild.nodeValue+="\n"+text
         e=fountain.lastChild
     else:
-        if fountain.hasChildNodes():
-            if fountain.lastChild.nodeName==ACTION:
-                if not fountain.lastChild.lastChild.nodeValue:
-                    # remove empty <action /> that comes from individual empty lines
-                    fountain.removeChild(fountain.lastChild)
+        end_element(fountain)
         e=subElementWithText(fountain, tag, text)
     return e
 
+def end_element(fountain):
+    if fountain.hasChildNodes():
+        if fountain.lastChild.nodeName==ACTION:
+            if not fountain.lastChild.lastChild.nodeValue:
+                # remove empty <action /> that comes from individual empty lines
+                removeLastChild(fountain)
+
 def push_scene_heading(parent, text, setting=None):
     tokens=re.split(r"(#.*?#$)", text)
     if len(tokens)==1:
@@ -306,92 +548,402 @@ def push_section_heading(parent, level, text):
 
 # Hierarchical Structures
 
-def structure_dialogue(doc):
-    for ch in doc.getElementsByTagName(CHARACTER):
-        subElement(ch, "name").appendChild(ch.firstChild)
-        # move extensions inside character
-        n=ch.nextSibling
-        while n and (n.nodeType!=n.ELEMENT_NODE or n.nodeName=="extension"):
-            ch.appendChild(n)
-            n=ch.nextSibling
-        # move lines and parentheticals inside dialogue
-        d=doc.createElement("dialogue")
-        d.appendChild(ch.parentNode.replaceChild(d, ch))
-        n=d.nextSibling
-        while n and (n.nodeType!=n.ELEMENT_NODE or n.nodeName in (PARENTHETICAL,
+# Each pass rebuilds the child lists of the parents it restructures in
+# one go: moving nodes one at a time out of a long list of siblings
+# costs time quadratic in the length of the script.
+
+# elements that stay in a scene after its heading
+SCENE_CONTENT = (SYNOPSIS, NOTE, ACTION, "dialogue", "dual-dialogue")
+
+def structure_dialogue(doc, hooks=None):
+    def close(d):
+        if hooks and d:
+            hooks.close(d)
+            if d.parentNode.nodeName=="dual-dialogue":
+                hooks.close(d.parentNode)
+    for parent in parentNodes(doc.getElementsByTagName(CHARACTER)):
+        ch=d=None
+        for n in detachChildren(parent):
+            if n.nodeName==CHARACTER:
+                close(d)
+                ch=n
+                d=doc.createElement("dialogue")
+                d.appendChild(ch)
+                # dual dialogue
+                if ch.getAttribute("dual")=="dual":
+                    ch.removeAttribute("dual")
+                    dd=doc.createElement("dual-dialogue")
+                    if parent.lastChild and parent.lastChild.nodeName=="dialogue":
+                        dd.appendChild(parent.lastChild)
+                    dd.appendChild(d)
+                    parent.appendChild(dd)
+                    if hooks:
+                        hooks.open(dd)
+                else:
+                    parent.appendChild(d)
+                if hooks:
+                    hooks.open(d)
+                subElement(ch, "name").appendChild(ch.firstChild)
+            elif ch and (n.nodeType!=n.ELEMENT_NODE or n.nodeName==EXTENSION):
+                # move extensions inside character
+                ch.appendChild(n)
+            elif d and (n.nodeType!=n.ELEMENT_NODE or n.nodeName in (PARENTHETICAL,
                                                                      DIALOGUE)):
-            d.appendChild(n)
-            n=d.nextSibling
-        # dual dialogue
-        if ch.getAttribute("dual")=="dual":
-            ch.removeAttribute("dual")
-            dd=doc.createElement("dual-dialogue")
-            dd.appendChild(d.parentNode.replaceChild(dd, d))
-            if dd.previousSibling.nodeName=="dialogue":
-                dd.insertBefore(dd.previousSibling, d)
-
-def structure_scenes(doc):
-    for sh in doc.getElementsByTagName(SCENE_HEADING):
-        s=doc.createElement("scene")
-        s.appendChild(sh.parentNode.replaceChild(s, sh))
-
-        # move @id up to scene
-        id=sh.getAttribute("id")
-        if id:
-            sh.removeAttribute("id")
-            s.setAttribute("id", id)
-
-        # move text to <location>
-        subElement(sh, "location").appendChild(sh.firstChild)
-
-        # move @setting and @tod to elements
-        setting=sh.getAttribute("setting")
-        if setting:
-            sh.removeAttribute("setting")
-            se=subElementWithText(sh, "setting", setting)
-            sh.insertBefore(se, sh.firstChild)
-
-        tod=sh.getAttribute("tod")
-        if tod:
-            sh.removeAttribute("tod")
-            te=subElementWithText(sh, "tod", tod)
-
-        n=s.nextSibling
-        while n and (n.nodeType!=n.ELEMENT_NODE or n.nodeName in (SYNOPSIS,
-                                                                  NOTE,
-                                                                  ACTION,
-                                                                  "dialogue",
-                                                                  "dual-dialogue")):
-            s.appendChild(n)
-            n=s.nextSibling
-
-def structure_sections(doc):
+                # move lines and parentheticals inside dialogue
+                ch=None
+                d.appendChild(n)
+            else:
+                close(d)
+                ch=d=None
+                parent.appendChild(n)
+        close(d)
+
+def structure_scenes(doc, hooks=None):
+    for parent in parentNodes(doc.getElementsByTagName(SCENE_HEADING)):
+        s=None
+        for n in detachChildren(parent):
+            if n.nodeName==SCENE_HEADING:
+                if hooks and s:
+                    hooks.close(s)
+                s=doc.createElement("scene")
+                parent.appendChild(s)
+                s.appendChild(n)
+                structure_scene_heading(s, n)
+                if hooks:
+                    hooks.open(s)
+            elif s and (n.nodeType!=n.ELEMENT_NODE or n.nodeName in SCENE_CONTENT):
+                s.appendChild(n)
+            else:
+                if hooks and s:
+                    hooks.close(s)
+                s=None
+                parent.appendChild(n)
+        if hooks and s:
+            hooks.close(s)
+
+def structure_scene_heading(s, sh):
+    # move @id up to scene
+    id=sh.getAttribute("id")
+    if id:
+        sh.removeAttribute("id")
+        s.setAttribute("id", id)
+
+    # move text to <location>
+    subElement(sh, "location").appendChild(sh.firstChild)
+
+    # move @setting and @tod to elements
+    setting=sh.getAttribute("setting")
+    if setting:
+        sh.removeAttribute("setting")
+        se=subElementWithText(sh, "setting", setting)
+        sh.insertBefore(se, sh.firstChild)
+
+    tod=sh.getAttribute("tod")
+    if tod:
+        sh.removeAttribute("tod")
+        te=subElementWithText(sh, "tod", tod)
+
+def structure_sections(doc, hooks=None):
+    # headings move, but stay the same nodes, so one search finds them all
+    all_headings=doc.getElementsByTagName(SECTION_HEADING)
     max_level=0
-    for sh in doc.getElementsByTagName(SECTION_HEADING):
+    for sh in all_headings:
         max_level=max(max_level, int(sh.getAttribute("level")))
     for level in range(1, max_level+1):
-        for sh in doc.getElementsByTagName(SECTION_HEADING):
-            if int(sh.getAttribute("level"))==level:
-                s=doc.createElement("section")
-                s.setAttribute("heading",
-                               sh.parentNode.replaceChild(s, sh).firstChild.nodeValue)
-                id=sh.getAttribute("id")
-                if id:
-                    s.setAttribute("id", id)
-                n=s.nextSibling
-                while n and (n.nodeType!=n.ELEMENT_NODE or n.nodeName not in (PAGE_BREAK)):
-                    if n.nodeName==SECTION_HEADING and int(n.getAttribute("level"))<=level:
-                        break
+        headings=[sh for sh in all_headings
+                  if int(sh.getAttribute("level"))==level]
+        for parent in parentNodes(headings):
+            s=None
+            for n in detachChildren(parent):
+                is_heading=n.nodeName==SECTION_HEADING
+                if is_heading and int(n.getAttribute("level"))==level:
+                    if hooks and s:
+                        hooks.close(s)
+                    s=doc.createElement("section")
+                    if hasattr(n, "source_lines"):
+                        s.source_lines=n.source_lines
+                    s.setAttribute("heading", n.firstChild.nodeValue)
+                    id=n.getAttribute("id")
+                    if id:
+                        s.setAttribute("id", id)
+                    parent.appendChild(s)
+                    if hooks:
+                        hooks.open(s)
+                elif s and (n.nodeType!=n.ELEMENT_NODE or n.nodeName!=PAGE_BREAK) \
+                     and not (is_heading and int(n.getAttribute("level"))<=level):
+                    # deeper headings stay inside; so do sections
+                    # from shallower (already processed) levels
                     s.appendChild(n)
-                    n=s.nextSibling
+                else:
+                    if hooks and s:
+                        hooks.close(s)
+                    s=None
+                    parent.appendChild(n)
+            if hooks and s:
+                hooks.close(s)
+
+def prune(doc, keep):
+    """Removes delimiters and characters that projection needed only
+    for structuring."""
+    for tag in (SCENE_HEADING, TRANSITION, PAGE_BREAK, CHARACTER):
+        if tag not in keep:
+            for e in doc.getElementsByTagName(tag):
+                e.parentNode.removeChild(e)
+
+# Digests
+
+# bump whenever digests of the same source change
+DIGEST_VERSION = 1
+DIGESTED = ("section", "scene", "dialogue")
+
+def normalize_sources(body, notes):
+    """Returns body lines in a form that doesn't depend on line endings,
+    Unicode normalization or notes elsewhere in the document."""
+    return [unicodedata.normalize("NFC",
+                                  re.sub(r"\[\[(\d+)\]\]",
+                                         lambda m: "[["+notes[int(m.group(1))]+"]]",
+                                         l))
+            for l in body]
+
+def add_digests(doc, args):
+    """Sets a digest attribute on every section, scene and dialogue: a
+    hash of the source lines of its elements, and of the options that
+    affect how those lines parse."""
+    options="fountainhead-digest-%d s=%d x=%d only=%s\n" % (
+        DIGEST_VERSION,
+        bool(args.semantic_linebreaks),
+        bool(args.syntax_extensions),
+        ",".join(sorted(args.only or [])))
+    element_digest(doc.documentElement, options)
+
+def element_digest(e, options):
+    if e.getAttribute("digest"):
+        # already done, in an included document
+        return e.getAttribute("digest")
+    h=hashlib.sha1(options)
+    h.update(e.nodeName.encode("utf-8")+"\n")
+    for l in getattr(e, "source_lines", ()):
+        h.update(l.encode("utf-8")+"\n")
+    for c in e.childNodes:
+        if c.nodeType==c.ELEMENT_NODE:
+            h.update(element_digest(c, options)+"\n")
+    digest=h.hexdigest()
+    if e.nodeName in DIGESTED:
+        e.setAttribute("digest", digest)
+    return digest
+
+# Pagination
+
+# Page geometry in lines and characters of Courier 12pt, by
+# screenplay convention, which ftx.css follows: 55 lines on a page,
+# 6in of action, 3.5in of dialogue
+PAGE_LINES = 55
+WIDTHS = {
+    SCENE_HEADING: 60, ACTION: 60, TRANSITION: 60,
+    CHARACTER: 38, PARENTHETICAL: 25, DIALOGUE: 35,
+    }
+# each column of dual dialogue
+DUAL_WIDTHS = {CHARACTER: 25, PARENTHETICAL: 25, DIALOGUE: 27}
+# elements that take no room on the page
+INVISIBLE = (TITLE_PAGE, SYNOPSIS, NOTE)
+
+def paginate(doc):
+    """Sets on each scene the pages it takes up and its length in
+    eighths of a page, and on the document element the page count."""
+    pages=Pages()
+    starts={}
+    for (e, block) in page_blocks(doc.documentElement, {}):
+        if block is None:
+            pages.annotate(e, starts.pop(e))
+        elif e.nodeName=="scene":
+            starts[e]=pages.place(block)
+        else:
+            pages.place(block)
+    doc.documentElement.setAttribute("pages", str(pages.last_page))
+    return pages.last_page
+
+def page_blocks(e, counts):
+    """Generates (element, block) for each element that takes up
+    lines on the page, in order, and (scene, None) after the last
+    block of each scene. A block is ("break",), (tag, lines), or
+    ("dialogue", cue lines, [(tag, lines)...])."""
+    for c in e.childNodes:
+        if c.nodeType!=c.ELEMENT_NODE or c.nodeName in INVISIBLE:
+            continue
+        if c.nodeName=="section":
+            for b in page_blocks(c, counts):
+                yield b
+        elif c.nodeName=="scene":
+            heading=c.getElementsByTagName(SCENE_HEADING)
+            text=heading and heading_text(heading[0]) or u""
+            yield c, (SCENE_HEADING, wrapped_lines(text, WIDTHS[SCENE_HEADING], counts))
+            for b in page_blocks(c, counts):
+                if b[0] not in heading:
+                    yield b
+            yield c, None
+        elif c.nodeName==PAGE_BREAK:
+            yield c, ("break",)
+        elif c.nodeName=="dialogue":
+            yield c, dialogue_block(c, WIDTHS, counts)
+        elif c.nodeName=="dual-dialogue":
+            # the columns sit side by side and never split
+            columns=[dialogue_block(d, DUAL_WIDTHS, counts)
+                     for d in c.childNodes if d.nodeName=="dialogue"]
+            yield c, ("dual-dialogue", max(cue+sum(n for (_, n) in parts)
+                                           for (_, cue, parts) in columns))
+        else:
+            width=WIDTHS.get(c.nodeName, WIDTHS[ACTION])
+            yield c, (c.nodeName, wrapped_lines(visible_text(c), width, counts))
+
+def heading_text(sh):
+    # as ftx.css displays it
+    text=dict((c.nodeName, visible_text(c)) for c in sh.childNodes)
+    return u"".join((text.get("setting") and text["setting"]+u" " or u"",
+                     text.get("location", u""),
+                     text.get("tod") and u" -- "+text["tod"] or u""))
+
+def dialogue_block(d, widths, counts):
+    cue=0
+    parts=[]
+    for c in d.childNodes:
+        if c.nodeName==CHARACTER:
+            cue=wrapped_lines(u" ".join(visible_text(n) for n in c.childNodes),
+                              widths[CHARACTER], counts)
+        elif c.nodeName in (PARENTHETICAL, DIALOGUE):
+            parts.append((c.nodeName, wrapped_lines(visible_text(c), widths[c.nodeName], counts)))
+    return ("dialogue", cue, parts)
+
+def visible_text(n):
+    if n.nodeType==n.TEXT_NODE:
+        return n.data
+    if n.nodeName in INVISIBLE:
+        return u""
+    return u"".join(visible_text(c) for c in n.childNodes)
+
+def wrapped_lines(text, width, counts):
+    """Returns the number of lines text takes up in a column width
+    characters wide. Each line of text wraps on its own, and lines
+    that fit, almost all of them, cost one comparison; counts caches
+    the rest."""
+    n=0
+    for l in text.strip().split("\n"):
+        if len(l)<=width:
+            n+=1
+        else:
+            key=(l, width)
+            if key not in counts:
+                counts[key]=wrap_count(l, width)
+            n+=counts[key]
+    return n
+
+def wrap_count(line, width):
+    lines=1
+    column=0
+    for word in line.split():
+        if column and column+1+len(word)<=width:
+            column+=1+len(word)
+        else:
+            if column:
+                lines+=1
+            # words longer than a line break anywhere
+            lines+=(len(word)-1)//width
+            column=(len(word)-1)%width+1
+    return lines
+
+class Pages(object):
+    """Places blocks on pages, by these rules: blocks have a blank line
+    between them, except at the top of a page; a scene heading needs
+    room for a line of what follows; action splits between lines,
+    leaving at least two on each page; dialogue splits only after a
+    line of dialogue, with (MORE) at the bottom of the page and the
+    cue, CONT'D, at the top of the next; anything else moves whole to
+    the next page."""
+
+    def __init__(self):
+        self.page=1
+        self.line=0
+        self.last_page=1
+
+    def room(self):
+        return PAGE_LINES-self.line
+
+    def position(self):
+        return self.page-1+float(self.line)/PAGE_LINES
+
+    def new_page(self):
+        if self.line:
+            self.page+=1
+            self.line=0
+
+    def fill(self, lines):
+        self.line+=lines
+        self.last_page=self.page
+        if self.line>=PAGE_LINES:
+            self.new_page()
+
+    def place(self, block):
+        """Places block and returns where it starts, as (page, position)."""
+        if block[0]=="break":
+            self.new_page()
+            return self.page, self.position()
+        if self.line:
+            self.fill(1)
+        if block[0]=="dialogue":
+            return self.place_dialogue(*block[1:])
+        tag, lines = block
+        if tag==SCENE_HEADING and lines+2>self.room():
+            self.new_page()
+        elif tag==ACTION and lines>self.room():
+            if min(self.room(), lines-2)<2:
+                self.new_page()
+        elif lines>self.room():
+            self.new_page()
+        start=self.page, self.position()
+        while lines>self.room():
+            # split action, or anything taller than a page
+            first=self.room() if lines-self.room()>=2 or tag!=ACTION else lines-2
+            lines-=first
+            self.fill(first)
+            self.new_page()
+        self.fill(lines)
+        return start
+
+    def place_dialogue(self, cue, parts):
+        lines=[tag for (tag, n) in parts for _ in range(n)]
+        if cue+len(lines)>self.room() and self.dialogue_split(cue, lines)==0:
+            self.new_page()
+        start=self.page, self.position()
+        while cue+len(lines)>self.room():
+            split=self.dialogue_split(cue, lines)
+            if not split:
+                # taller than a page, but can't split: it overflows
+                break
+            self.fill(cue+split+1)
+            self.new_page()
+            lines=lines[split:]
+        self.fill(cue+len(lines))
+        return start
+
+    def dialogue_split(self, cue, lines):
+        """Returns how many lines of dialogue fit on this page with the
+        cue and (MORE), ending in a line of dialogue, or 0."""
+        for split in range(min(len(lines)-1, self.room()-cue-1), 0, -1):
+            if lines[split-1]==DIALOGUE:
+                return split
+        return 0
+
+    def annotate(self, scene, start):
+        page, position = start
+        last_page=self.last_page
+        eighths=max(1, int(8*(self.position()-position)+0.5))
+        scene.setAttribute("pages", "%d-%d" % (page, last_page) if last_page>page else str(page))
+        scene.setAttribute("eighths", str(eighths))
+
 
 # Inline Formatting and Mixed Content
 
-def parse_inlines(doc, semantic_linebreaks, syntax_extensions):
-    if syntax_extensions:
-        m=FountainInlinesExt()
-    else:
-        m=FountainInlines()
+def parse_inlines(doc, semantic_linebreaks, syntax_extensions, m=None, hooks=None):
+    m=m or inline_engine(syntax_extensions)
     # assuming these have text-only content at this point
     for tag in (TITLE_VALUE, ACTION, DIALOGUE):
         for e in doc.getElementsByTagName(tag):
@@ -411,13 +963,29 @@ def parse_inlines(doc, semantic_linebreaks, syntax_extensions):
             for n, l in enumerate(lines):
                 if n:
                     appendText(e, "\n")
-                mds=m.convert(l)
-                if mds:
-                    p=xml.dom.minidom.parseString(mds.encode("utf-8")).documentElement
-                    for a in p.getElementsByTagName("a"):
-                        breakdown_link(a)
+                p=convert_inline(m, l)
+                if p:
+                    made=hooks and p.getElementsByTagName("bd")
                     while p.firstChild:
                         e.appendChild(p.firstChild)
+                    for bd in made or ():
+                        hooks.made(bd)
+
+def inline_engine(syntax_extensions):
+    if syntax_extensions:
+        return FountainInlinesExt()
+    else:
+        return FountainInlines()
+
+def convert_inline(m, line):
+    """Returns a <p> element with inline markup of a single line, or
+    None if the line converts to nothing."""
+    mds=m.convert(line)
+    if mds:
+        p=xml.dom.minidom.parseString(mds.encode("utf-8")).documentElement
+        for a in p.getElementsByTagName("a"):
+            breakdown_link(a)
+        return p
 
 def breakdown_link(a):
     bd=ownerDocument(a).createElement("bd")
@@ -501,9 +1069,11 @@ class FountainInlinesExt(FountainInlines):
         self.inlinePatterns.register(ip.LinkInlineProcessor(ip.LINK_RE, self), 'link', 160)
 
 
-def reconstitute_notes(doc, notes):
+def reconstitute_notes(doc, notes, hooks=None):
     for n in doc.getElementsByTagName(NOTE):
         appendText(n, notes[int(n.removeChild(n.firstChild).nodeValue)])
+        if hooks:
+            hooks.made(n)
 
     # "The empty lines around the Note on its own line would be removed in parsing."
     line_notes=[]
@@ -544,21 +1114,49 @@ def filename_fragment(filename, infilename):
     fragment=len(tokens)==2 and tokens[1] or None
     return name, fragment
 
-def process_includes(doc, args):
+def process_includes(doc, args, engine=None, parse=parse_fountain):
     for i in doc.getElementsByTagName(INCLUDE):
         filename, fragment_id=filename_fragment(i.firstChild.nodeValue, args.infile.name)
+        registered=None
         try:
+            if i.firstChild.nodeValue.startswith("#"):
+                # no filename: the project's registry knows where the id is
+                filename=i.firstChild.nodeValue
+                registered=resolve_id(fragment_id, args.infile.name)
+                filename=registered[0]
+            if args.included is not None:
+                args.included.append(filename)
             f=open(filename)
-        except IOError as e:
+        except (IOError, RegistryError) as e:
             # "Fountain does its best to sensibly interpret the text file
             # into screenplay formatting. When in doubt, Fountain returns
             # text as Action."
             a=doc.createElement(ACTION)
             a.appendChild(doc.createTextNode(filename + ": " + e.strerror))
             i.parentNode.replaceChild(a, i)
-            return
-        child_doc=parse_fountain(f, args)
-        fragment=fragment_id and findElementByAttributeValue(child_doc, "id", fragment_id)
+            continue
+        if args.xinclude:
+            f.close()
+            i.parentNode.replaceChild(xinclude(doc, filename, fragment_id, args, engine), i)
+            continue
+        fragment=None
+        if fragment_id:
+            if registered and registered[1] is not None:
+                # straight to its lines
+                _, start, end, notes_before = registered
+                f.seek(start)
+                fragment=parse_region(io.BytesIO(f.read(end-start)).readlines(), notes_before,
+                                      fragment_id, args, engine, parse)
+                f.seek(0)
+            if not fragment:
+                lines=f.readlines()
+                fragment=parse_fragment(lines, fragment_id, args, engine, parse)
+            if not fragment:
+                # the scan can't tell, or got it wrong; parse it all
+                child_doc=parse(lines, args, engine)
+                fragment=findElementByAttributeValue(child_doc, "id", fragment_id)
+        else:
+            child_doc=parse(f, args, engine)
         if fragment:
             i.parentNode.replaceChild(fragment, i)
         else:
@@ -570,6 +1168,304 @@ def process_includes(doc, args):
                 e = child_doc.documentElement.firstChild
             i.parentNode.removeChild(i)
 
+def fragment_region(lines, fragment_id, syntax_extensions):
+    """Returns the source lines from the scene or section heading with
+    this id up to and including the heading that ends it, found by a
+    scan of the text, and the number of notes before them. The lines
+    parse into the same scene or section as the whole file does.
+    Returns None if the scan can't tell."""
+    found=fragment_lines(lines, fragment_id, syntax_extensions)
+    if found:
+        start, end, notes_before = found
+        return lines[start:end], notes_before
+
+def fragment_lines(lines, fragment_id, syntax_extensions, decoded=None):
+    """Returns where fragment_region() finds its lines, as a slice of
+    lines, and the number of notes before them. Callers that look up
+    many ids can pass the decoded lines."""
+    marker="#%s#" % fragment_id.encode("utf-8")
+    body_start=None
+    for (start, l) in enumerate(lines):
+        if not l.rstrip().endswith(marker):
+            continue
+        if body_start is None:
+            decoded=decoded or decode_lines(lines)
+            title, body = split_title_body(decoded)
+            body_start=len(decoded)-len(body)
+        if start<body_start:
+            continue
+        # the heading is what the lines above leave it
+        prefix="\n".join(decoded[body_start:start])
+        if prefix.rfind("/*")>prefix.rfind("*/") or prefix.rfind("[[")>prefix.rfind("]]"):
+            return None
+        neighbours="".join(lines[max(body_start, start-1):start+2])
+        if "/*" in neighbours or "*/" in neighbours or "]]" in neighbours:
+            # boneyard and notes around it could make it a heading or not
+            return None
+        rest=decoded[start:]
+        tag, _, level = classify_line(rest[0], len(rest)>1 and rest[1] or None,
+                                      None, True, syntax_extensions)
+        if tag not in CHUNK_HEADINGS:
+            continue
+        if tag==SCENE_HEADING and start>body_start and decoded[start-1]:
+            return None
+        end=len(lines)
+        for (n, (next_tag, _, next_level)) in enumerate(classify_lines(rest, syntax_extensions)):
+            if n==0:
+                continue
+            if tag==SCENE_HEADING and next_tag in CHUNK_HEADINGS:
+                end=start+n+1
+                break
+            if tag==SECTION_HEADING and next_tag==SECTION_HEADING and next_level<=level:
+                if next_level<level:
+                    # a shallower section would nest in this one
+                    return None
+                end=start+n+1
+                break
+        region=lines[start:end]
+        text="".join(region)
+        if "/*" in text or "*/" in text or any(l.count("[[")!=l.count("]]") for l in region):
+            # boneyard and notes can change lines, and with them the headings
+            return None
+        notes_before=len(re.findall(r"\[\[.*?\]\]", re.sub(r"(/\*.*?\*/)", "", prefix, flags=re.DOTALL),
+                                    flags=re.DOTALL))
+        return start, end, notes_before
+    return None
+
+def parse_fragment(lines, fragment_id, args, engine=None, parse=parse_fountain):
+    """Returns the scene or section with this id, parsing only the
+    lines fragment_region() finds for it, or None if it finds none."""
+    found=fragment_region(lines, fragment_id, args.syntax_extensions)
+    if not found:
+        return None
+    region, notes_before = found
+    return parse_region(region, notes_before, fragment_id, args, engine, parse)
+
+def parse_region(region, notes_before, fragment_id, args, engine=None, parse=parse_fountain):
+    e=findElementByAttributeValue(parse(region, args, engine), "id", fragment_id)
+    if e and notes_before:
+        # notes number from the start of the file; their numbers show
+        # where notes don't belong, e.g. in character names
+        renumber=lambda m: "[[%d]]" % (int(m.group(1))+notes_before)
+        for n in [e]+e.getElementsByTagName("*"):
+            for (name, value) in n.attributes.items():
+                n.setAttribute(name, NOTE_PLACEHOLDER.sub(renumber, value))
+            for c in n.childNodes:
+                if c.nodeType==c.TEXT_NODE:
+                    c.data=NOTE_PLACEHOLDER.sub(renumber, c.data)
+    return e
+
+# XInclude
+
+# With --xinclude, includes become xi:include references to the FTX of
+# the included files, written next to them, instead of copies of their
+# content: a file that many scripts include converts once, and readers
+# load it when they need it. Nested includes resolve against the file
+# that has them, as their hrefs do. An included file's .ftx is
+# rewritten only when it's older than the file, or was written with
+# other options than these, which file.ftx.options records.
+
+XINCLUDE_NS = "http://www.w3.org/2001/XInclude"
+# options that change an included file's FTX
+XINCLUDE_OPTIONS = ("semantic_linebreaks", "syntax_extensions", "css", "meta", "digests",
+                    "paginate", "only")
+
+def xinclude(doc, filename, fragment_id, args, engine=None):
+    """Returns an xi:include of the scene or section with fragment_id
+    in filename or, without one, of all but its title page, writing
+    its FTX first if that's out of date."""
+    target=os.path.splitext(filename)[0]+".ftx"
+    converting=args.xincluded if args.xincluded is not None else set()
+    options=json.dumps(dict((name, getattr(args, name)) for name in XINCLUDE_OPTIONS), sort_keys=True)
+    try:
+        with open(target+".options") as f:
+            fresh=(f.read()==options and
+                   os.path.getmtime(target)>=os.path.getmtime(filename))
+    except (IOError, OSError):
+        fresh=False
+    if not fresh and os.path.abspath(target) not in converting:
+        # an include cycle ends at a file it's already converting
+        converting.add(os.path.abspath(target))
+        with open(filename) as f:
+            child_doc=parse_fountain(f, updated_args(args, infile=f, xincluded=converting), engine)
+        with open(target+"_", "wb") as out:
+            write_ftx(child_doc, out)
+            out.write("\n")
+        os.rename(target+"_", target)
+        # after the FTX: if this doesn't happen, it's rewritten next time
+        with open(target+".options", "w") as f:
+            f.write(options)
+    x=doc.createElementNS(XINCLUDE_NS, "xi:include")
+    x.setAttribute("xmlns:xi", XINCLUDE_NS)
+    x.setAttribute("href", os.path.relpath(target, os.path.dirname(args.infile.name)))
+    if fragment_id:
+        x.setAttribute("xpointer", "xpointer(//*[@id=%s])" % xpointer_string(fragment_id))
+    else:
+        x.setAttribute("xpointer", "xpointer(/fountain/node()[not(self::%s)])" % TITLE_PAGE)
+    return x
+
+def xpointer_string(s):
+    """Returns s as an XPath string literal, escaped for the xpointer()
+    scheme, where ^, ( and ) need a ^ before them."""
+    s=re.sub(r"([()^])", r"^\1", s)
+    if "'" not in s:
+        return "'%s'" % s
+    if '"' not in s:
+        return '"%s"' % s
+    # no quotes for a literal with both
+    return "concat(%s)" % ", \"'\", ".join("'%s'" % part for part in s.split("'"))
+
+# Id registry
+
+# A registry lists the ids of scenes and sections in the scripts under
+# its directory, so =<#id includes them from wherever they are. Where a
+# scan of the text finds the lines that parse into a scene or section,
+# the registry keeps their byte range; where it can't tell, it keeps
+# only the file, and including parses all of it. Paths are relative to
+# the registry, and each script is rescanned only when its size or
+# modification time changed.
+
+IDS = "fountainhead-ids.db"
+
+IDS_VERSION = 1
+
+IDS_SCHEMA = """
+CREATE TABLE files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+CREATE TABLE ids (id TEXT, path TEXT, start INTEGER, end INTEGER, notes INTEGER);
+CREATE INDEX ids_id ON ids (id);
+CREATE INDEX ids_path ON ids (path);
+"""
+
+# an id at the end of a line that may be a heading
+ID_MARKER = re.compile(r"#([^#]+)#$")
+
+class RegistryError(EnvironmentError):
+    """=<#id can't resolve: no registry, or no or many scripts with the id."""
+
+    def __init__(self, message):
+        EnvironmentError.__init__(self, None, message)
+
+def find_registry(directory):
+    """Returns the registry in directory or the nearest directory above
+    it, or None."""
+    directory=os.path.abspath(directory)
+    while True:
+        registry=os.path.join(directory, IDS)
+        if os.path.exists(registry):
+            return registry
+        parent=os.path.dirname(directory)
+        if parent==directory:
+            return None
+        directory=parent
+
+def scan_ids(lines):
+    """Returns (id, start, end, notes before) for each scene and section
+    id in lines, with the byte range of its lines, or None for the range
+    where a scan can't tell."""
+    offsets=[0]
+    for l in lines:
+        offsets.append(offsets[-1]+len(l))
+    decoded=None
+    found=[]
+    uncertain=False
+    for l in lines:
+        m=ID_MARKER.search(l.rstrip())
+        if not m:
+            continue
+        decoded=decoded or decode_lines(lines)
+        fragment_id=m.group(1).decode("utf-8")
+        region=fragment_lines(lines, fragment_id, True, decoded)
+        if region:
+            start, end, notes_before = region
+            found.append((fragment_id, offsets[start], offsets[end], notes_before))
+        else:
+            found.append((fragment_id, None, None, None))
+            uncertain=True
+    if uncertain:
+        # a flat parse tells which of the others are really headings
+        doc=parse_fountain(lines, updated_args(parse_options().parse_args(["-x"]), flat_output=True))
+        ids=set(e.getAttribute("id") for tag in CHUNK_HEADINGS
+                for e in doc.getElementsByTagName(tag))
+        found=[f for f in found if f[1] is not None or f[0] in ids]
+    # the first heading with an id is the one that counts
+    seen=set()
+    return [f for f in found if f[0] not in seen and not seen.add(f[0])]
+
+def update_registry(registry):
+    """Brings the registry up to date with the scripts under its
+    directory. Returns the paths it (re)scanned."""
+    root=os.path.dirname(os.path.abspath(registry))
+    db=open_database(registry, IDS_VERSION, IDS_SCHEMA)
+    scanned=[]
+    with db:
+        known=dict((path, (mtime, size))
+                   for (path, mtime, size) in db.execute("SELECT path, mtime, size FROM files"))
+        for (directory, dirs, files) in os.walk(root):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith(".fountain"):
+                    continue
+                path=os.path.relpath(os.path.join(directory, name), root)
+                st=os.stat(os.path.join(root, path))
+                if known.pop(path, None)==(st.st_mtime, st.st_size):
+                    continue
+                with open(os.path.join(root, path)) as f:
+                    ids=scan_ids(f.readlines())
+                db.execute("DELETE FROM ids WHERE path=?", (path,))
+                db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, st.st_mtime, st.st_size))
+                db.executemany("INSERT INTO ids VALUES (?, ?, ?, ?, ?)",
+                               [(i, path, start, end, notes) for (i, start, end, notes) in ids])
+                scanned.append(path)
+        for path in known:
+            # gone
+            db.execute("DELETE FROM ids WHERE path=?", (path,))
+            db.execute("DELETE FROM files WHERE path=?", (path,))
+    db.close()
+    return scanned
+
+def duplicate_ids(registry):
+    """Returns the ids that more than one script has, with those scripts."""
+    db=open_database(registry, IDS_VERSION, IDS_SCHEMA)
+    duplicates=collections.OrderedDict()
+    for (fragment_id, path) in db.execute("SELECT id, path FROM ids WHERE id IN"
+                                          " (SELECT id FROM ids GROUP BY id HAVING COUNT(*)>1)"
+                                          " ORDER BY id, path"):
+        duplicates.setdefault(fragment_id, []).append(path)
+    db.close()
+    return duplicates
+
+def resolve_id(fragment_id, infilename):
+    """Returns the script with the scene or section with this id, and
+    the byte range and notes before of its lines, or Nones where the
+    registry doesn't know them. Raises RegistryError if it can't."""
+    registry=find_registry(os.path.dirname(os.path.abspath(infilename)))
+    if not registry:
+        raise RegistryError("no %s here or above; run fountainhead.py ids" % IDS)
+    root=os.path.dirname(registry)
+    def lookup():
+        db=open_database(registry, IDS_VERSION, IDS_SCHEMA)
+        rows=db.execute("SELECT ids.path, start, end, notes, mtime, size FROM ids NATURAL JOIN files"
+                        " WHERE id=?", (fragment_id,)).fetchall()
+        db.close()
+        return rows
+    def fresh(path, mtime, size):
+        try:
+            st=os.stat(os.path.join(root, path))
+        except OSError:
+            return False
+        return (st.st_mtime, st.st_size)==(mtime, size)
+    rows=lookup()
+    if len(rows)!=1 or not fresh(*rows[0][0:1]+rows[0][4:]):
+        # moved, changed, new or duplicated since the last update
+        update_registry(registry)
+        rows=lookup()
+    if not rows:
+        raise RegistryError("no script in %s has #%s#" % (root, fragment_id))
+    if len(rows)>1:
+        raise RegistryError("#%s# is in %s" % (fragment_id, ", ".join(sorted(r[0] for r in rows))))
+    path, start, end, notes_before, _, _ = rows[0]
+    return os.path.join(root, path), start, end, notes_before
+
 # DOM utilities
 
 # This is part of DOM Level 1, but apparently has quirks in minidom
@@ -590,95 +1486,1893 @@ def subElementWithText(e, tagName, text):
     appendText(e, text)
     return e
 
+def detachChildren(e):
+    """Empties e in one go and returns its former children, which
+    can then be appended elsewhere without a search through e."""
+    children=list(e.childNodes)
+    del e.childNodes[:]
+    for c in children:
+        c.parentNode=c.previousSibling=c.nextSibling=None
+    return children
+
+def removeLastChild(e):
+    """Same as e.removeChild(e.lastChild), without minidom's search
+    through all of e's children."""
+    c=e.childNodes.pop()
+    if e.childNodes:
+        e.childNodes[-1].nextSibling=None
+    c.parentNode=c.previousSibling=c.nextSibling=None
+    return c
+
+def parentNodes(elements):
+    """Returns the distinct parents of elements, in order."""
+    parents=[]
+    seen=set()
+    for e in elements:
+        if id(e.parentNode) not in seen:
+            seen.add(id(e.parentNode))
+            parents.append(e.parentNode)
+    return parents
+
+def textContent(n):
+    if n.nodeType==n.TEXT_NODE:
+        return n.nodeValue
+    return "".join(map(textContent, n.childNodes))
+
 def findElementByAttributeValue(n, attr, value):
     for e in n.getElementsByTagName("*"):
         if e.getAttributeNode(attr) and e.getAttribute(attr)==value:
             return e
 
-# This monkey patches the pretty-printer in xml.dom.minidom to indent
-# block-level elements but not mixed content ones. The function mostly
-# follows the standard implementation, except for the elif clause that
-# special-cases mixed-content elements.
-def writexml(self, writer, indent="", addindent="", newl=""):
-    # indent = current indentation
-    # addindent = indentation to add to higher levels
-    # newl = newline string
-    writer.write(indent+"<" + self.tagName)
-
-    attrs = self._get_attributes()
-    a_names = attrs.keys()
-    a_names.sort()
-
-    for a_name in a_names:
-        writer.write(" %s=\"" % a_name)
-        xml.dom.minidom._write_data(writer, attrs[a_name].value)
-        writer.write("\"")
-    if self.childNodes:
-        writer.write(">")
-        if (len(self.childNodes) == 1 and
-            self.childNodes[0].nodeType == xml.dom.minidom.Node.TEXT_NODE):
-            self.childNodes[0].writexml(writer, '', '', '')
-        elif self.nodeName in [SCENE_HEADING, CHARACTER, ACTION, DIALOGUE, TITLE_VALUE]:
-            for node in self.childNodes:
-                node.writexml(writer, "", "", "")
+# Serialization
+
+# elements with mixed content; pretty output doesn't indent inside them
+MIXED_CONTENT = (SCENE_HEADING, CHARACTER, ACTION, DIALOGUE, TITLE_VALUE)
+
+def escape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+        replace("\"", "&quot;").replace(">", "&gt;")
+
+def write_ftx(node, out, pretty=False, offsets=None):
+    """Writes node (a document or an element) to binary stream out as
+    UTF-8 XML. Pretty output indents block-level elements, but not
+    mixed-content ones. Unlike minidom's pretty-printer, this leaves
+    xml.dom.minidom alone for other code in the process. If offsets is
+    a list, it receives (element, start, end) with the byte range of
+    each section and scene in the output. Returns the number of bytes
+    written."""
+    buf=[]
+    w=buf.append
+    # bytes written before buf
+    written=[0]
+    def flush():
+        data="".join(buf).encode("utf-8")
+        out.write(data)
+        written[0]+=len(data)
+        del buf[:]
+    def start_unit(n):
+        flush()
+        units[n]=len(offsets)
+        offsets.append((n, written[0], None))
+    def end_unit(n, newl):
+        flush()
+        offsets[units[n]]=(n, offsets[units[n]][1], written[0]-len(newl))
+    units={}
+    # each entry is (node, indent, newline); None in place of a node
+    # means indent holds a closing tag to write, and newline the
+    # element it closes if that's a unit for offsets
+    stack=[(node, "", pretty and "\n" or "")]
+    pop=stack.pop
+    push=stack.append
+    while stack:
+        n, indent, newl = pop()
+        if n is None:
+            w(indent)
+            if newl is not None:
+                end_unit(newl, indent[len(indent.rstrip("\n")):])
+            continue
+        t=n.nodeType
+        if t==n.TEXT_NODE:
+            w(escape(indent+n.data+newl))
+        elif t==n.ELEMENT_NODE:
+            tag=n.tagName
+            unit=offsets is not None and tag in SIDECAR_UNITS
+            w(indent)
+            if unit:
+                start_unit(n)
+            w("<"+tag)
+            if n.hasAttributes():
+                for name, value in sorted(n.attributes.items()):
+                    w(' %s="%s"' % (name, escape(value)))
+            children=n.childNodes
+            if not children:
+                w("/>"+newl)
+                if unit:
+                    end_unit(n, newl)
+            elif len(children)==1 and children[0].nodeType==n.TEXT_NODE:
+                w(">"+escape(children[0].data)+"</"+tag+">"+newl)
+                if unit:
+                    end_unit(n, newl)
+            elif not newl or tag in MIXED_CONTENT:
+                w(">")
+                push((None, "</"+tag+">"+newl, n if unit else None))
+                for c in reversed(children):
+                    push((c, "", ""))
+            else:
+                w(">"+newl)
+                push((None, indent+"</"+tag+">"+newl, n if unit else None))
+                cindent=indent+"  "
+                for c in reversed(children):
+                    push((c, cindent, newl))
+        elif t==n.PROCESSING_INSTRUCTION_NODE:
+            w("%s<?%s %s?>%s" % (indent, n.target, n.data, newl))
+        elif t==n.DOCUMENT_NODE:
+            w('<?xml version="1.0" encoding="utf-8"?>'+newl)
+            for c in reversed(n.childNodes):
+                push((c, "", newl))
+        if len(buf)>=4096:
+            flush()
+    flush()
+    return written[0]
+
+def pprint(node):
+    s=io.BytesIO()
+    write_ftx(node, s, pretty=True)
+    return s.getvalue()
+
+
+# Sidecar index
+
+# A sidecar (file.ftx.idx) lists where each section and scene of an
+# FTX file starts and how long it is, so readers can take one out of
+# a large file without parsing the rest. It's JSON: for each unit
+# type, [id, offset, length] in document order, along with the size
+# of the FTX file, which tells a sidecar that no longer matches.
+SIDECAR_UNITS = ("section", "scene")
+
+SIDECAR_VERSION = 1
+
+def write_sidecar(offsets, size, out):
+    """Writes the sidecar of an FTX file of this size, from the offsets
+    write_ftx() gave for it."""
+    sidecar=collections.OrderedDict((("version", SIDECAR_VERSION), ("size", size)))
+    for unit in SIDECAR_UNITS:
+        sidecar[unit]=[(e.getAttribute("id") or None, start, end-start)
+                       for (e, start, end) in offsets if e.tagName==unit]
+    json.dump(sidecar, out, separators=(",", ":"))
+
+class FtxIndex(object):
+    """Reads sections and scenes out of an FTX file through its sidecar.
+    Units are numbered from 1 in document order, or named by id."""
+
+    def __init__(self, filename, sidecar=None):
+        with open(sidecar or filename+".idx") as f:
+            self.sidecar=json.load(f)
+        if self.sidecar.get("version")!=SIDECAR_VERSION:
+            raise ValueError("%s: unknown sidecar version" % filename)
+        self.ids=dict((unit, dict((id, n) for (n, (id, _, _)) in enumerate(self.sidecar[unit], 1) if id))
+                      for unit in SIDECAR_UNITS)
+        with open(filename, "rb") as f:
+            size=os.fstat(f.fileno()).st_size
+            if size!=self.sidecar["size"]:
+                raise ValueError("%s: sidecar doesn't match" % filename)
+            self.map=size and mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def xml(self, unit, key):
+        """Returns the XML of a section or scene, by number or id, as
+        UTF-8; raises KeyError if there's none."""
+        n=self.ids[unit][key] if isinstance(key, basestring) else key
+        if n<1 or n>len(self.sidecar[unit]):
+            raise KeyError(key)
+        _, start, length = self.sidecar[unit][n-1]
+        return self.map[start:start+length]
+
+    def element(self, unit, key):
+        """Returns a section or scene as a minidom element."""
+        return xml.dom.minidom.parseString(self.xml(unit, key)).documentElement
+
+    def scene(self, key):
+        return self.element("scene", key)
+
+    def section(self, key):
+        return self.element("section", key)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+
+# Event stream
+
+# JSON Lines schema, one JSON array per line:
+#   ["fountain-events", version]   header, first line only
+#   ["open", name, {attributes}]   element start; attributes omitted if none
+#   ["text", text]                 character data
+#   ["close", name]                element end
+# Events nest exactly as elements do in FTX. Version changes whenever
+# the schema does.
+EVENTS_SCHEMA = "fountain-events"
+EVENTS_VERSION = 1
+
+def ftx_events(node):
+    """Generates open, text and close events for node and its
+    descendants, in document order."""
+    stack=[node]
+    while stack:
+        n=stack.pop()
+        if isinstance(n, tuple):
+            yield n
+        elif n.nodeType==n.TEXT_NODE:
+            yield ("text", n.data)
+        elif n.nodeType==n.ELEMENT_NODE:
+            if n.hasAttributes():
+                yield ("open", n.tagName, dict(n.attributes.items()))
+            else:
+                yield ("open", n.tagName)
+            stack.append(("close", n.tagName))
+            stack.extend(reversed(n.childNodes))
+        elif n.nodeType==n.DOCUMENT_NODE:
+            stack.extend(reversed(n.childNodes))
+
+def write_events(node, out):
+    """Writes events for node to binary stream out as JSON Lines, one
+    line per event as it comes."""
+    for e in itertools.chain([(EVENTS_SCHEMA, EVENTS_VERSION)], ftx_events(node)):
+        out.write(json.dumps(e, ensure_ascii=False, sort_keys=True,
+                             separators=(",", ":")).encode("utf-8")+"\n")
+
+
+# Shards
+
+MANIFEST = "manifest.json"
+
+def write_shards(doc, directory):
+    """Writes each top-level section or scene of doc, together with
+    the elements that follow it up to the next one, as a separate FTX
+    document in directory. Files are named after their content hash,
+    so unchanged shards keep their files (and timestamps) from run to
+    run. Moves the nodes out of doc. Returns the manifest, which lists
+    the shards in document order."""
+    groups=[]
+    for n in list(doc.documentElement.childNodes):
+        if not groups or n.nodeName in ("section", "scene"):
+            groups.append([])
+        groups[-1].append(n)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest_filename=os.path.join(directory, MANIFEST)
+    try:
+        with open(manifest_filename) as f:
+            old_files=set(s["file"] for s in json.load(f)["shards"])
+    except (IOError, ValueError, KeyError):
+        old_files=set()
+    shards=[]
+    for group in groups:
+        shard=xml.dom.minidom.getDOMImplementation().createDocument(None, "fountain", None)
+        for n in doc.childNodes:
+            if n.nodeType==n.PROCESSING_INSTRUCTION_NODE:
+                shard.insertBefore(shard.createProcessingInstruction(n.target, n.data),
+                                   shard.documentElement)
+        for n in group:
+            shard.documentElement.appendChild(n)
+        s=io.BytesIO()
+        write_ftx(shard, s)
+        data=s.getvalue()
+        digest=hashlib.sha1(data).hexdigest()
+        filename=digest[:16]+".ftx"
+        path=os.path.join(directory, filename)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        shards.append({"file": filename,
+                       "sha1": digest,
+                       "element": group[0].nodeName,
+                       "id": group[0].getAttribute("id") or None})
+    for filename in old_files-set(s["file"] for s in shards):
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            pass
+    manifest={"version": 1, "shards": shards}
+    with open(manifest_filename, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, separators=(",", ": "))
+    return manifest
+
+
+# Revisions
+
+# units of revision: each has a fingerprint of its own content,
+# exclusive of nested units
+UNITS = ("section", "scene")
+# elements whose changes diff_children() marks on their children
+REVISION_CONTAINERS = ("dialogue", "dual-dialogue", TITLE_PAGE, TITLE_KEY)
+
+def revision_units(doc):
+    """Returns the document element followed by all sections and
+    scenes, in document order."""
+    return [doc.documentElement]+[e for e in doc.documentElement.getElementsByTagName("*")
+                                  if e.nodeName in UNITS]
+
+def unit_digest(e):
+    s=io.BytesIO()
+    s.write(e.tagName.encode("utf-8"))
+    for name, value in sorted(e.attributes.items()):
+        s.write((' %s="%s"' % (name, escape(value))).encode("utf-8"))
+    for c in e.childNodes:
+        if c.nodeName not in UNITS:
+            write_ftx(c, s)
+    return hashlib.sha1(s.getvalue()).hexdigest()
+
+def unit_key(e, digest):
+    # ids survive edits, content hashes don't
+    if e.parentNode.nodeType==e.DOCUMENT_NODE:
+        return ("root",)
+    if e.getAttribute("id"):
+        return ("id", e.nodeName, e.getAttribute("id"))
+    return ("digest", e.nodeName, digest)
+
+def increasing_subsequence(pairs):
+    """Returns the longest subsequence of pairs, sorted on their second
+    members, whose first members also increase."""
+    tails=[]
+    tail_index=[]
+    previous=[None]*len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        k=bisect.bisect_left(tails, i)
+        if k:
+            previous[n]=tail_index[k-1]
+        if k==len(tails):
+            tails.append(i)
+            tail_index.append(n)
+        else:
+            tails[k]=i
+            tail_index[k]=n
+    result=[]
+    if tail_index:
+        n=tail_index[-1]
+        while n is not None:
+            result.append(pairs[n])
+            n=previous[n]
+    return result[::-1]
+
+def align_units(old, new):
+    """Pairs units of two drafts, given as lists of (key, unit). Units
+    with a key unique in both drafts anchor the alignment; units
+    without ids between anchors pair up in order, scenes with scenes
+    and sections with sections. Returns (old index or None, new index or None)
+    pairs for every unit."""
+    old_count=collections.Counter(k for k, e in old)
+    new_count=collections.Counter(k for k, e in new)
+    old_index=dict((k, i) for i, (k, e) in enumerate(old) if old_count[k]==1)
+    anchors=increasing_subsequence(
+        [(old_index[k], j) for j, (k, e) in enumerate(new)
+         if new_count[k]==1 and k in old_index])
+    pairs=[]
+    pi, pj = -1, -1
+    for i, j in anchors+[(len(old), len(new))]:
+        by_tag={}
+        omitted=[]
+        for oi in range(pi+1, i):
+            if old[oi][0][0]=="digest":
+                by_tag.setdefault(old[oi][1].nodeName, []).append(oi)
+            else:
+                omitted.append(oi)
+        for nj in range(pj+1, j):
+            candidates=new[nj][0][0]=="digest" and by_tag.get(new[nj][1].nodeName)
+            if candidates:
+                pairs.append((candidates.pop(0), nj))
+            else:
+                pairs.append((None, nj))
+        for candidates in by_tag.values():
+            omitted.extend(candidates)
+        pairs.extend((oi, None) for oi in sorted(omitted))
+        if i<len(old):
+            pairs.append((i, j))
+        pi, pj = i, j
+    return pairs
+
+def diff_drafts(old_doc, new_doc):
+    """Marks sections and scenes of new_doc that differ from those of
+    old_doc, and the elements that differ inside them, with revised
+    attributes: "changed" or "added". Scenes and sections missing from
+    new_doc come back empty, marked "omitted". Returns new_doc."""
+    old=[]
+    for e in revision_units(old_doc):
+        d=unit_digest(e)
+        old.append((unit_key(e, d), e, d))
+    new=[]
+    for e in revision_units(new_doc):
+        d=unit_digest(e)
+        new.append((unit_key(e, d), e, d))
+    pairs=align_units([(k, e) for k, e, d in old], [(k, e) for k, e, d in new])
+    # what each old unit became, omitted ones included
+    new_of={}
+    for oi, nj in pairs:
+        if oi is not None:
+            new_of[oi]=new[nj][1] if nj is not None else omitted_unit(new_doc, old[oi][1])
+    old_index=dict((id(e), i) for i, (k, e, d) in enumerate(old))
+    previous_unit=None
+    for oi, nj in pairs:
+        if nj is not None:
+            previous_unit=new[nj][1]
+            if oi is None:
+                previous_unit.setAttribute("revised", "added")
+            elif old[oi][2]!=new[nj][2]:
+                if nj:
+                    previous_unit.setAttribute("revised", "changed")
+                diff_children(old[oi][1], previous_unit)
+        else:
+            # back in what its old parent became, after the unit before
+            # it if that's in there too
+            parent=new_of[old_index[id(old[oi][1].parentNode)]]
+            after=previous_unit
+            while after and after.parentNode is not parent:
+                after=after.parentNode
+            if after:
+                before=after.nextSibling
+            else:
+                before=next((c for c in parent.childNodes if c.nodeName in UNITS), None)
+            parent.insertBefore(new_of[oi], before)
+            previous_unit=new_of[oi]
+    return new_doc
+
+def omitted_unit(doc, e):
+    o=doc.createElement(e.nodeName)
+    for name, value in e.attributes.items():
+        o.setAttribute(name, value)
+    o.setAttribute("revised", "omitted")
+    for sh in e.getElementsByTagName(SCENE_HEADING)[:1]:
+        o.appendChild(sh.cloneNode(True))
+    return o
+
+def diff_children(old, new):
+    a=[c for c in old.childNodes if c.nodeType==c.ELEMENT_NODE and c.nodeName not in UNITS]
+    b=[c for c in new.childNodes if c.nodeType==c.ELEMENT_NODE and c.nodeName not in UNITS]
+    sm=difflib.SequenceMatcher(None, map(serialize, a), map(serialize, b), autojunk=False)
+    for op, i1, i2, j1, j2 in sm.get_opcodes():
+        if op=="equal":
+            continue
+        for k in range(j1, j2):
+            c=b[k]
+            if op=="replace" and i1+k-j1<i2 and a[i1+k-j1].nodeName==c.nodeName:
+                c.setAttribute("revised", "changed")
+                if c.nodeName in REVISION_CONTAINERS:
+                    diff_children(a[i1+k-j1], c)
+            else:
+                c.setAttribute("revised", "added")
+
+def serialize(node):
+    s=io.BytesIO()
+    write_ftx(node, s)
+    return s.getvalue()
+
+
+# Plot summary
+
+# plot summary needs only synopses and the structure around them
+PLOT_SUMMARY_ONLY = (TITLE_PAGE, SYNOPSIS)
+
+# title page keys in plot summary, in order of appearance
+PLOT_SUMMARY_KEYS = (
+    ("Title", "# %s\n\n"),
+    ("Logline", "%s\n\n"),
+    ("Project Home", "## <%s>\n\n"),
+    ("Version", "### revision: %s\n\n"),
+)
+
+def plot_summary(lines, args):
+    """Returns the same markdown as plot-summary.xslt does for the FTX
+    of this document."""
+    args=updated_args(args, only=PLOT_SUMMARY_ONLY, flat_output=False)
+    return summarize(parse_fountain(lines, args))
+
+def summarize(doc):
+    """Returns the plot summary of FTX, projected or not."""
+    out=[]
+    for tp in doc.getElementsByTagName(TITLE_PAGE):
+        for name, template in PLOT_SUMMARY_KEYS:
+            for k in tp.getElementsByTagName(TITLE_KEY):
+                if k.getAttribute("name")==name:
+                    value=""
+                    values=k.getElementsByTagName(TITLE_VALUE)
+                    if values:
+                        value=textContent(values[0])
+                    out.append(template % value)
+    out.append("# Plot Summary")
+    summarize_sections(doc.documentElement, 0, out)
+    out.append("\n\n")
+    return "".join(out)
+
+def summarize_sections(e, depth, out):
+    for n in e.childNodes:
+        if n.nodeName=="section":
+            out.append("\n\n%s %s\n\n" % ("#"*(depth+2), n.getAttribute("heading")))
+            summarize_sections(n, depth+1, out)
+        elif n.nodeName==SYNOPSIS:
+            text=textContent(n)
+            if text:
+                out.append(text)
+                s=n.nextSibling
+                while s and s.nodeName!=SYNOPSIS:
+                    s=s.nextSibling
+                if s:
+                    out.append("\n")
+        elif n.nodeType==n.ELEMENT_NODE and n.nodeName!=TITLE_PAGE:
+            summarize_sections(n, depth, out)
+
+
+# Corpus index
+
+# The index is an SQLite database: each script's text elements
+# ("blocks") with their scene and speaker, and postings from lowercased
+# terms to blocks. Bump INDEX_VERSION whenever the schema or what goes
+# into it changes; older indexes are rebuilt from scratch.
+INDEX_VERSION = 1
+INDEX_SCHEMA = """
+CREATE TABLE scripts (id INTEGER PRIMARY KEY, path TEXT UNIQUE, sha1 TEXT);
+CREATE TABLE scenes (script INTEGER, scene INTEGER, id TEXT,
+                     setting TEXT, location TEXT, tod TEXT,
+                     PRIMARY KEY (script, scene));
+CREATE TABLE blocks (id INTEGER PRIMARY KEY, script INTEGER, scene INTEGER,
+                     element TEXT, character TEXT, class TEXT, text TEXT);
+CREATE TABLE postings (term TEXT, block INTEGER);
+CREATE INDEX blocks_script ON blocks (script);
+CREATE INDEX postings_term ON postings (term);
+"""
+
+# elements indexed as blocks, besides bd
+INDEXED = (SCENE_HEADING, ACTION, PARENTHETICAL, DIALOGUE, TRANSITION, SYNOPSIS)
+
+TERM = re.compile(r"\w+", re.UNICODE)
+
+def terms(text):
+    return set(t.lower() for t in TERM.findall(text))
+
+def open_index(filename):
+    return open_database(filename, INDEX_VERSION, INDEX_SCHEMA)
+
+def open_database(filename, version, schema):
+    """Connects to an SQLite database, replacing its tables with the
+    schema unless it has this version already."""
+    db=sqlite3.connect(filename)
+    if db.execute("PRAGMA user_version").fetchone()[0]!=version:
+        for (table,) in db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+            db.execute("DROP TABLE "+table)
+        db.executescript(schema)
+        db.execute("PRAGMA user_version = %d" % version)
+    return db
+
+def script_digest(filename, args):
+    """Fingerprints a script, its includes and the options that parse it."""
+    h=hashlib.sha1("s=%d x=%d P=%d\n" % (bool(args.semantic_linebreaks),
+                                         bool(args.syntax_extensions),
+                                         bool(args.paginate)))
+    with open(filename) as f:
+        h.update(f.read())
+        f.seek(0)
+        deps=sorted(find_dependencies(f)) if args.syntax_extensions else []
+    for d in deps:
+        try:
+            with open(d) as f:
+                h.update(d+"\0"+f.read())
+        except IOError:
+            pass
+    return h.hexdigest()
+
+def index_scripts(filename, paths, args):
+    """Brings the index up to date with these scripts, reparsing only
+    those whose content changed, and forgets scripts that no longer
+    exist. Returns the paths it (re)indexed."""
+    db=open_index(filename)
+    indexed=[]
+    with db:
+        for (script, path) in db.execute("SELECT id, path FROM scripts").fetchall():
+            if not os.path.exists(path):
+                forget_script(db, script)
+                db.execute("DELETE FROM scripts WHERE id=?", (script,))
+        for p in paths:
+            path=os.path.abspath(p)
+            sha1=script_digest(path, args)
+            row=db.execute("SELECT id, sha1 FROM scripts WHERE path=?", (path,)).fetchone()
+            if row and row[1]==sha1:
+                continue
+            if row:
+                script=row[0]
+                forget_script(db, script)
+                db.execute("UPDATE scripts SET sha1=? WHERE id=?", (sha1, script))
+            else:
+                script=db.execute("INSERT INTO scripts (path, sha1) VALUES (?, ?)",
+                                  (path, sha1)).lastrowid
+            with open(path) as f:
+                doc=parse_fountain(f, updated_args(args, infile=f, digests=False))
+            index_document(db, script, doc)
+            indexed.append(p)
+    db.close()
+    return indexed
+
+def forget_script(db, script):
+    db.execute("DELETE FROM postings WHERE block IN (SELECT id FROM blocks WHERE script=?)", (script,))
+    db.execute("DELETE FROM blocks WHERE script=?", (script,))
+    db.execute("DELETE FROM scenes WHERE script=?", (script,))
+
+def index_document(db, script, doc):
+    scenes={}
+    for (n, s) in enumerate(doc.getElementsByTagName("scene"), 1):
+        scenes[s]=n
+        sh=s.getElementsByTagName(SCENE_HEADING)
+        heading=[sh and sh[0].getElementsByTagName(t) for t in ("setting", "location", "tod")]
+        db.execute("INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?)",
+                   [script, n, s.getAttribute("id") or None]
+                   + [h and textContent(h[0]).strip() or None for h in heading])
+    for e in doc.documentElement.getElementsByTagName("*"):
+        if e.tagName not in INDEXED and e.tagName!="bd":
+            continue
+        scene=0
+        character=None
+        p=e.parentNode
+        while p.nodeType==p.ELEMENT_NODE:
+            if p.tagName=="dialogue" and character is None:
+                name=p.getElementsByTagName("name")
+                character=name and textContent(name[0]).strip() or ""
+            if p.tagName=="scene":
+                scene=scenes[p]
+                break
+            p=p.parentNode
+        if e.tagName==SCENE_HEADING:
+            text=" ".join(textContent(c) for c in e.childNodes)
+        else:
+            text=textContent(e)
+        bd_class=e.getAttribute("class") or None if e.tagName=="bd" else None
+        block=db.execute("INSERT INTO blocks (script, scene, element, character, class, text)"
+                         " VALUES (?, ?, ?, ?, ?, ?)",
+                         (script, scene, e.tagName, character or None, bd_class, text)).lastrowid
+        words=terms(text)
+        if e.tagName=="bd":
+            words |= terms(e.getAttribute("idref"))
+        db.executemany("INSERT INTO postings VALUES (?, ?)", [(t, block) for t in words])
+
+def search_index(filename, words, character=None, element=None,
+                 setting=None, location=None, tod=None, bd_class=None):
+    """Returns (path, scene, scene id, element, character, text) for
+    each block containing all the words and matching the filters."""
+    query=["SELECT scripts.path, blocks.scene, scenes.id, blocks.element,"
+           " blocks.character, blocks.text"
+           " FROM blocks JOIN scripts ON blocks.script=scripts.id"
+           " LEFT JOIN scenes ON scenes.script=blocks.script AND scenes.scene=blocks.scene"
+           " WHERE 1"]
+    params=[]
+    for t in sorted(set(w for word in words for w in terms(word))):
+        query.append("blocks.id IN (SELECT block FROM postings WHERE term=?)")
+        params.append(t)
+    filters=(("upper(blocks.character)=?", character and character.upper()),
+             ("blocks.element=?", element),
+             ("rtrim(upper(scenes.setting), '.')=?", setting and setting.upper().rstrip(".")),
+             ("upper(scenes.location) LIKE ?", location and "%"+location.upper()+"%"),
+             ("upper(scenes.tod)=?", tod and tod.upper()),
+             ("blocks.class=?", bd_class))
+    for (condition, value) in filters:
+        if value:
+            query.append(condition)
+            params.append(value)
+    db=open_index(filename)
+    rows=db.execute(" AND ".join(query)+" ORDER BY scripts.path, blocks.id", params).fetchall()
+    db.close()
+    return rows
+
+
+# SQLite export
+
+# Tables of scripts, keyed by script and position in it; a script's
+# rows go and come back together. Bump DATABASE_VERSION whenever the
+# schema or what goes into it changes.
+DATABASE_VERSION = 1
+DATABASE_TABLES = """
+CREATE TABLE scripts (script INTEGER PRIMARY KEY, path TEXT UNIQUE, sha1 TEXT, title TEXT);
+CREATE TABLE sections (script INTEGER, section INTEGER, parent INTEGER,
+                       id TEXT, heading TEXT,
+                       PRIMARY KEY (script, section));
+CREATE TABLE scenes (script INTEGER, scene INTEGER, section INTEGER, id TEXT,
+                     setting TEXT, location TEXT, tod TEXT, pages TEXT, eighths INTEGER,
+                     PRIMARY KEY (script, scene));
+CREATE TABLE characters (script INTEGER, character INTEGER, name TEXT,
+                         PRIMARY KEY (script, character));
+CREATE TABLE dialogue (script INTEGER, line INTEGER, scene INTEGER, block INTEGER,
+                       character INTEGER, extension TEXT, parenthetical TEXT,
+                       dual INTEGER, text TEXT,
+                       PRIMARY KEY (script, line));
+CREATE TABLE breakdown (script INTEGER, item INTEGER, scene INTEGER,
+                        class TEXT, idref TEXT, text TEXT,
+                        PRIMARY KEY (script, item));
+CREATE TABLE notes (script INTEGER, note INTEGER, scene INTEGER, text TEXT,
+                    PRIMARY KEY (script, note));
+"""
+# created after the rows go in
+DATABASE_INDEXES = """
+CREATE INDEX IF NOT EXISTS scenes_section ON scenes (script, section);
+CREATE INDEX IF NOT EXISTS dialogue_scene ON dialogue (script, scene);
+CREATE INDEX IF NOT EXISTS dialogue_character ON dialogue (script, character);
+CREATE INDEX IF NOT EXISTS breakdown_scene ON breakdown (script, scene);
+CREATE INDEX IF NOT EXISTS breakdown_idref ON breakdown (class, idref);
+CREATE INDEX IF NOT EXISTS notes_scene ON notes (script, scene);
+"""
+DATABASE_ROWS = ("sections", "scenes", "characters", "dialogue", "breakdown", "notes")
+
+def write_database(filename, path, args):
+    """Replaces the rows of the script at path, unless it hasn't
+    changed since the last time; returns whether it did."""
+    path=os.path.abspath(path)
+    sha1=script_digest(path, args)
+    db=open_database(filename, DATABASE_VERSION, DATABASE_TABLES)
+    row=db.execute("SELECT script, sha1 FROM scripts WHERE path=?", (path,)).fetchone()
+    if row and row[1]==sha1:
+        db.close()
+        return False
+    with open(path) as f:
+        doc=parse_fountain(f, updated_args(args, infile=f))
+    rows=database_rows(doc)
+    # one transaction
+    with db:
+        if row:
+            script=row[0]
+            for table in DATABASE_ROWS:
+                db.execute("DELETE FROM %s WHERE script=?" % table, (script,))
+            db.execute("UPDATE scripts SET sha1=?, title=? WHERE script=?",
+                       (sha1, rows["title"], script))
         else:
-            writer.write(newl)
-            for node in self.childNodes:
-                node.writexml(writer, indent+addindent, addindent, newl)
-            writer.write(indent)
-        writer.write("</%s>%s" % (self.tagName, newl))
+            script=db.execute("INSERT INTO scripts (path, sha1, title) VALUES (?, ?, ?)",
+                              (path, sha1, rows["title"])).lastrowid
+        for table in DATABASE_ROWS:
+            if rows[table]:
+                db.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join("?"*(len(rows[table][0])+1))),
+                               [(script,)+r for r in rows[table]])
+    db.executescript(DATABASE_INDEXES)
+    db.close()
+    return True
+
+def database_rows(doc):
+    """Returns the title and, for each table, the rows of a script,
+    all but the script column."""
+    rows=dict((table, []) for table in DATABASE_ROWS)
+    rows["title"]=None
+    for k in doc.getElementsByTagName(TITLE_KEY):
+        if k.getAttribute("name").lower()=="title":
+            rows["title"]=u" ".join(textContent(v).strip() for v in k.childNodes)
+    characters={}
+    blocks=[]
+    def walk(e, section, scene):
+        for c in e.childNodes:
+            if c.nodeType!=c.ELEMENT_NODE or c.nodeName==TITLE_PAGE:
+                continue
+            if c.nodeName=="section":
+                n=len(rows["sections"])+1
+                rows["sections"].append((n, section, c.getAttribute("id") or None,
+                                         c.getAttribute("heading")))
+                walk(c, n, scene)
+                continue
+            if c.nodeName=="scene":
+                n=len(rows["scenes"])+1
+                heading=dict((h.nodeName, textContent(h)) for sh in c.getElementsByTagName(SCENE_HEADING)
+                             for h in sh.childNodes)
+                rows["scenes"].append((n, section, c.getAttribute("id") or None,
+                                       heading.get("setting"), heading.get("location"), heading.get("tod"),
+                                       c.getAttribute("pages") or None,
+                                       c.getAttribute("eighths") and int(c.getAttribute("eighths")) or None))
+                walk(c, section, n)
+                continue
+            if c.nodeName=="dialogue":
+                blocks.append(c)
+                dialogue_rows(c, scene, len(blocks), characters, rows)
+            elif c.nodeName=="bd":
+                rows["breakdown"].append((len(rows["breakdown"])+1, scene,
+                                          c.getAttribute("class"), c.getAttribute("idref"), visible_text(c)))
+            elif c.nodeName==NOTE:
+                rows["notes"].append((len(rows["notes"])+1, scene, textContent(c)))
+            # breakdown and notes can be anywhere
+            walk(c, section, scene)
+    walk(doc.documentElement, None, None)
+    return rows
+
+def dialogue_rows(d, scene, block, characters, rows):
+    name=d.getElementsByTagName("name")
+    name=name and textContent(name[0]) or u""
+    if name not in characters:
+        characters[name]=len(characters)+1
+        rows["characters"].append((characters[name], name))
+    extension=u" ".join(textContent(x) for x in d.getElementsByTagName(EXTENSION)) or None
+    dual=int(d.parentNode.nodeName=="dual-dialogue")
+    parenthetical=None
+    for c in d.childNodes:
+        if c.nodeName==PARENTHETICAL:
+            parenthetical=textContent(c)
+        elif c.nodeName==DIALOGUE:
+            rows["dialogue"].append((len(rows["dialogue"])+1, scene, block, characters[name],
+                                     extension, parenthetical, dual, visible_text(c)))
+            parenthetical=None
+
+
+# Breakdown sheets
+
+# breakdown classes, in the order ftx.dtd declares them
+BD_CLASSES = ("character", "extra", "stunts", "fx", "sound", "vehicle",
+              "animal", "prop", "wardrobe", "makeup", "other")
+
+def breakdown_sheets(doc):
+    """Returns a breakdown sheet for each scene: its number, id,
+    heading, pages and eighths (with -P), and the elements of each
+    breakdown class in it, in order of first appearance. Breakdown
+    outside scenes goes on a sheet for scene 0."""
+    rows=database_rows(doc)
+    sheets=collections.OrderedDict()
+    for (n, _, id, setting, location, tod, pages, eighths) in rows["scenes"]:
+        heading=heading_line(setting, location, tod)
+        sheets[n]=collections.OrderedDict((("scene", n), ("id", id), ("heading", heading),
+                                           ("pages", pages), ("eighths", eighths),
+                                           ("elements", collections.OrderedDict())))
+    for (_, scene, bd_class, idref, text) in rows["breakdown"]:
+        scene=scene or 0
+        if scene not in sheets:
+            sheets[scene]=collections.OrderedDict((("scene", 0), ("id", None), ("heading", None),
+                                                   ("pages", None), ("eighths", None),
+                                                   ("elements", collections.OrderedDict())))
+        # without an idref, the text names the element
+        element=idref or u" ".join(text.split())
+        elements=sheets[scene]["elements"].setdefault(bd_class, [])
+        if element not in elements:
+            elements.append(element)
+    return sorted(sheets.values(), key=lambda sheet: sheet["scene"])
+
+def heading_line(setting, location, tod):
+    return u" - ".join(filter(None, (u" ".join(filter(None, (setting, location))), tod)))
+
+def element_index(sheets):
+    """Returns the scenes each element appears in, by class."""
+    index=collections.OrderedDict()
+    for sheet in sheets:
+        for (bd_class, elements) in sheet["elements"].items():
+            for e in elements:
+                index.setdefault(bd_class, collections.OrderedDict()).setdefault(e, []).append(sheet["scene"])
+    return index
+
+def write_breakdown(doc, directory):
+    """Writes breakdown sheets and the element index into directory,
+    each as CSV and as JSON."""
+    sheets=breakdown_sheets(doc)
+    index=element_index(sheets)
+    classes=list(BD_CLASSES)+sorted(set(index)-set(BD_CLASSES))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, "breakdown.json"), "w") as f:
+        json.dump(sheets, f, indent=2, separators=(",", ": "))
+    with open(os.path.join(directory, "elements.json"), "w") as f:
+        json.dump(index, f, indent=2, separators=(",", ": "))
+    with open(os.path.join(directory, "breakdown.csv"), "wb") as f:
+        w=csv.writer(f)
+        w.writerow(["scene", "id", "heading", "pages", "eighths"]+classes)
+        for sheet in sheets:
+            w.writerow(csv_row([sheet["scene"], sheet["id"], sheet["heading"], sheet["pages"], sheet["eighths"]]
+                               +[u"; ".join(sheet["elements"].get(c, ())) for c in classes]))
+    with open(os.path.join(directory, "elements.csv"), "wb") as f:
+        w=csv.writer(f)
+        w.writerow(["class", "element", "scenes"])
+        for (bd_class, elements) in index.items():
+            for (e, scenes) in elements.items():
+                w.writerow(csv_row([bd_class, e, u" ".join(map(unicode, scenes))]))
+
+def csv_row(values):
+    # the csv module wants bytes
+    return [v.encode("utf-8") if isinstance(v, unicode) else "" if v is None else v
+            for v in values]
+
+
+# Cast matrix
+
+def cast_matrix(doc, rows=None):
+    """Returns the scenes of doc as (number, id, heading), and for each
+    character, in order of the first scene they appear in, the scenes
+    they appear in as a bitset, bit n for scene n, and the number of lines they speak
+    in each scene that they speak in. Characters appear by speaking, or
+    by breakdown of class character, whose idref or text, in upper
+    case, names them. Scene 0 holds whatever is outside scenes. Rows,
+    if given, are database_rows() of doc."""
+    rows=rows or database_rows(doc)
+    scenes=[(n, id, heading_line(setting, location, tod))
+            for (n, _, id, setting, location, tod, _, _) in rows["scenes"]]
+    names=dict(rows["characters"])
+    presence=collections.OrderedDict()
+    lines=collections.defaultdict(collections.Counter)
+    def appear(name, scene):
+        if name:
+            presence[name]=presence.get(name, 0) | 1<<(scene or 0)
+    # dialogue and breakdown come in document order, each on its own
+    for (_, scene, _, character, _, _, _, _) in rows["dialogue"]:
+        appear(names[character], scene)
+        lines[names[character]][scene or 0]+=1
+    for (_, scene, bd_class, idref, text) in rows["breakdown"]:
+        if bd_class=="character":
+            appear((idref or u" ".join(text.split())).upper(), scene)
+    if any(p & 1 for p in presence.values()):
+        scenes.insert(0, (0, None, None))
+    # p & -p is the lowest bit set, the first scene
+    return scenes, sorted([(name, p, dict(lines[name])) for (name, p) in presence.items()],
+                          key=lambda (_, p, _2): p & -p)
+
+def write_cast_matrix(doc, directory):
+    """Writes the cast matrix into directory, as CSV with a row for
+    each scene and a column for each character, and as JSON."""
+    scenes, cast = cast_matrix(doc)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, "cast.json"), "w") as f:
+        json.dump(collections.OrderedDict((
+            ("scenes", [collections.OrderedDict((("scene", n), ("id", id), ("heading", heading)))
+                        for (n, id, heading) in scenes]),
+            # lines in each of the scenes
+            ("characters", [collections.OrderedDict((
+                ("name", name),
+                ("scenes", [n for (n, _, _) in scenes if presence>>n & 1]),
+                ("lines", [lines.get(n, 0) for (n, _, _) in scenes if presence>>n & 1])))
+                            for (name, presence, lines) in cast]))),
+                  f, indent=2, separators=(",", ": "))
+    with open(os.path.join(directory, "cast.csv"), "wb") as f:
+        w=csv.writer(f)
+        w.writerow(csv_row(["scene", "id", "heading"]+[name for (name, _, _) in cast]))
+        for (n, id, heading) in scenes:
+            # lines spoken, or x for appearing without a line
+            w.writerow(csv_row([n, id, heading]+[lines.get(n, "x") if presence>>n & 1 else None
+                                                 for (_, presence, lines) in cast]))
+
+
+# Stripboard
+
+# A stripboard has a strip for each scene of each episode, which
+# scheduling sorts and groups, and indexes from setting, location and
+# time of day to strips, so picking out, say, every EXT NIGHT scene at
+# the DOCKS intersects three lists. --stripboard keeps the strips of
+# every episode written to its directory, and replaces an episode's
+# own when it's written again.
+
+STRIP_FIELDS = ("episode", "scene", "id", "setting", "location", "tod", "pages", "eighths", "cast")
+STRIP_INDEXES = ("setting", "location", "tod")
+
+class Stripboard(object):
+    """Strips in order, with an index for each of STRIP_INDEXES from
+    values, in upper case and without dots in settings, to the
+    positions of the strips that have them."""
+
+    def __init__(self, strips=()):
+        self.strips=[]
+        self.indexes=dict((field, collections.defaultdict(list)) for field in STRIP_INDEXES)
+        for strip in strips:
+            self.add(strip)
+
+    def add(self, strip):
+        for field in STRIP_INDEXES:
+            self.indexes[field][strip_value(field, strip[field])].append(len(self.strips))
+        self.strips.append(strip)
+
+    def select(self, **values):
+        """Returns the strips with these values of setting, location
+        or tod, in order, e.g. select(setting="EXT", tod="night")."""
+        found=None
+        for (field, value) in values.items():
+            positions=set(self.indexes[field].get(strip_value(field, value), ()))
+            found=positions if found is None else found & positions
+        if found is None:
+            return list(self.strips)
+        return [self.strips[n] for n in sorted(found)]
+
+    def groups(self, *fields):
+        """Returns (values, strips) for each combination of values of
+        fields that strips have, in order of values."""
+        groups=collections.defaultdict(list)
+        for strip in self.strips:
+            groups[tuple(strip_value(f, strip[f]) for f in fields)].append(strip)
+        return sorted(groups.items())
+
+def strip_value(field, value):
+    value=u" ".join((value or u"").upper().split())
+    return value.replace(u".", u"") if field=="setting" else value
+
+def episode_strips(doc, episode):
+    """Returns the strips of the scenes of doc, in one walk of it."""
+    rows=database_rows(doc)
+    scenes, cast = cast_matrix(doc, rows)
+    return [collections.OrderedDict(zip(STRIP_FIELDS, (
+                episode, n, id, setting, location, tod, pages, eighths,
+                [name for (name, presence, _) in cast if presence>>n & 1])))
+            for (n, _, id, setting, location, tod, pages, eighths) in rows["scenes"]]
+
+def read_stripboard(directory):
+    """Returns the Stripboard written to directory, if any."""
+    try:
+        with open(os.path.join(directory, "stripboard.json")) as f:
+            strips=json.load(f, object_pairs_hook=collections.OrderedDict)["strips"]
+    except IOError:
+        strips=[]
+    return Stripboard(strips)
+
+def write_stripboard(doc, episode, directory):
+    """Replaces the strips of episode on the stripboard in directory,
+    or adds them, and writes it as CSV and JSON."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    old=read_stripboard(directory).strips
+    # in the old episode's place
+    at=next((n for (n, s) in enumerate(old) if s["episode"]==episode), len(old))
+    board=Stripboard([s for s in old[:at] if s["episode"]!=episode]+episode_strips(doc, episode)
+                     +[s for s in old[at:] if s["episode"]!=episode])
+    with open(os.path.join(directory, "stripboard.json"), "w") as f:
+        json.dump(collections.OrderedDict((
+            ("strips", board.strips),
+            ("indexes", collections.OrderedDict((field, collections.OrderedDict(sorted(board.indexes[field].items())))
+                                                for field in STRIP_INDEXES)))),
+                  f, indent=2, separators=(",", ": "))
+    with open(os.path.join(directory, "stripboard.csv"), "wb") as f:
+        w=csv.writer(f)
+        w.writerow(STRIP_FIELDS)
+        for strip in board.strips:
+            w.writerow(csv_row([strip[field] for field in STRIP_FIELDS[:-1]]+[u"; ".join(strip["cast"])]))
+    return board
+
+
+# Statistics
+
+# fountainhead.py stats notes the scenes, action and dialogue of a
+# script with a Hooks visitor as the parse makes them, and counts them
+# once it's done, when inline formatting and pagination are in. Counts
+# are plain ordered dicts by setting, time of day and character, and
+# lists by scene; a corpus adds its scripts' together.
+
+class ScriptStats(object):
+    """Hooks visitor that counts, for each scene, its words of action
+    and of dialogue and its length in eighths of a page, and for the
+    script, scenes by setting and by time of day, and speeches and
+    words by character. Scene 0 holds whatever is outside scenes."""
+
+    def __init__(self, script=None):
+        self.script=script
+        self.scene_ids=[None]
+        self.headings=[None]
+        self.scene_action=[0]
+        self.scene_dialogue=[0]
+        self.scene_eighths=[0]
+        self.settings=collections.OrderedDict()
+        self.tods=collections.OrderedDict()
+        self.speeches=collections.OrderedDict()
+        self.words=collections.OrderedDict()
+        # elements of the parse, until finish()
+        self.scenes={}
+        self.actions=[]
+        self.dialogues=[]
+
+    def close_scene(self, e):
+        self.scenes[e]=len(self.scene_ids)
+        parts=dict((c.nodeName, u" ".join(visible_text(c).split()))
+                   for c in e.getElementsByTagName(SCENE_HEADING)[0].childNodes
+                   if c.nodeType==c.ELEMENT_NODE)
+        tally(self.settings, parts.get("setting", u"").upper().replace(u".", u""))
+        tally(self.tods, parts.get("tod", u"").upper())
+        self.scene_ids.append(e.getAttribute("id") or None)
+        self.headings.append(heading_line(parts.get("setting"), parts.get("location"), parts.get("tod")))
+        for counts in (self.scene_action, self.scene_dialogue, self.scene_eighths):
+            counts.append(0)
+
+    def close_action(self, e):
+        self.actions.append(e)
+
+    def close_dialogue(self, e):
+        self.dialogues.append(e)
+
+    def scene_of(self, e):
+        while e and e.nodeName!="scene":
+            e=e.parentNode
+        return self.scenes.get(e, 0)
+
+    def finish(self):
+        """Counts the elements noted during the parse, and forgets
+        them."""
+        for e in self.actions:
+            self.scene_action[self.scene_of(e)]+=len(visible_text(e).split())
+        for e in self.dialogues:
+            name=e.getElementsByTagName("name")
+            name=name and textContent(name[0]) or u""
+            words=sum(len(visible_text(l).split()) for l in e.getElementsByTagName(DIALOGUE))
+            tally(self.speeches, name)
+            tally(self.words, name, words)
+            self.scene_dialogue[self.scene_of(e)]+=words
+        for (e, n) in self.scenes.items():
+            self.scene_eighths[n]=int(e.getAttribute("eighths") or 0)
+        self.scenes={}
+        self.actions=[]
+        self.dialogues=[]
+
+    def extend(self, other):
+        """Adds the counts of other, as if one script."""
+        # scene 0 of both is one
+        for (mine, theirs) in ((self.scene_action, other.scene_action),
+                               (self.scene_dialogue, other.scene_dialogue),
+                               (self.scene_eighths, other.scene_eighths)):
+            mine[0]+=theirs[0]
+            mine+=theirs[1:]
+        self.scene_ids+=other.scene_ids[1:]
+        self.headings+=other.headings[1:]
+        for (mine, theirs) in ((self.settings, other.settings), (self.tods, other.tods),
+                               (self.speeches, other.speeches), (self.words, other.words)):
+            for (key, n) in theirs.items():
+                tally(mine, key, n)
+
+def tally(counts, key, n=1):
+    counts[key]=counts.get(key, 0)+n
+
+def script_stats(path, args):
+    stats=ScriptStats(path)
+    hooks=Hooks()
+    hooks.add_visitor(stats)
+    with open(path) as f:
+        parse_fountain(f, updated_args(args, infile=f, paginate=True, jobs=1), hooks=hooks)
+    stats.finish()
+    return stats
+
+def stats_worker((path, args)):
+    return script_stats(path, args)
+
+def stats_report(stats, scenes=True):
+    """Returns the report of stats, with words for each of its scenes
+    if scenes. Scenes take a page a minute."""
+    real=stats.scene_ids[1:]
+    action=sum(stats.scene_action)
+    dialogue=sum(stats.scene_dialogue)
+    eighths=sum(stats.scene_eighths)
+    report=collections.OrderedDict((
+        ("script", stats.script),
+        ("scenes", len(real)),
+        ("pages", eighths/8.0),
+        ("runtime_minutes", round(eighths/8.0, 1)),
+        ("action_words", action),
+        ("dialogue_words", dialogue),
+        ("action_dialogue_ratio", round(float(action)/dialogue, 3) if dialogue else None),
+        # "" for none
+        ("settings", stats.settings),
+        ("tods", stats.tods),
+        # by dialogue share
+        ("characters", [collections.OrderedDict((
+            ("name", name), ("speeches", stats.speeches[name]), ("words", words),
+            ("dialogue_share", round(float(words)/dialogue, 3) if dialogue else None)))
+                        for (name, words) in sorted(stats.words.items(), key=lambda (_, w): -w)])))
+    if scenes:
+        report["scene_words"]=[collections.OrderedDict((
+            ("scene", n), ("id", stats.scene_ids[n]), ("heading", stats.headings[n]),
+            ("action_words", stats.scene_action[n]), ("dialogue_words", stats.scene_dialogue[n]),
+            ("eighths", stats.scene_eighths[n])))
+                               for n in xrange(len(stats.scene_ids))
+                               if n or stats.scene_action[0] or stats.scene_dialogue[0]]
+    return report
+
+def corpus_stats(paths, args):
+    """Returns the reports of each script, and, for more than one, of
+    all of them together, script None, without scenes."""
+    if args.jobs>1 and len(paths)>1:
+        pool=multiprocessing.Pool(min(args.jobs, len(paths)))
+        try:
+            all_stats=pool.map(stats_worker, [(p, args) for p in paths], chunksize=1)
+        finally:
+            pool.terminate()
     else:
-        writer.write("/>%s"%(newl))
-xml.dom.minidom.Element.writexml = writexml
-def pprint(doc):
-    return doc.toprettyxml(indent="  ", encoding="utf-8")
+        all_stats=[script_stats(p, args) for p in paths]
+    reports=[stats_report(s) for s in all_stats]
+    if len(all_stats)>1:
+        total=ScriptStats()
+        for s in all_stats:
+            total.extend(s)
+        reports.append(stats_report(total, scenes=False))
+    return reports
+
+def write_stats_csv(reports, out):
+    """Writes reports as CSV rows of script, measure, key and value."""
+    w=csv.writer(out)
+    w.writerow(["script", "measure", "key", "value"])
+    for r in reports:
+        row=lambda measure, key, value: w.writerow(csv_row([r["script"], measure, key, value]))
+        for measure in ("scenes", "pages", "runtime_minutes", "action_words", "dialogue_words",
+                        "action_dialogue_ratio"):
+            row(measure, None, r[measure])
+        for measure in ("settings", "tods"):
+            for (key, n) in r[measure].items():
+                row(measure, key, n)
+        for c in r["characters"]:
+            for measure in ("speeches", "words", "dialogue_share"):
+                row(measure, c["name"], c[measure])
+        for sc in r.get("scene_words", []):
+            key=sc["id"] or sc["scene"]
+            for measure in ("action_words", "dialogue_words", "eighths"):
+                row("scene_"+measure, key, sc[measure])
+
+
+# Live preview
+
+# Preview reparses only the chunks of source that changed: a chunk
+# starts at a scene or section heading and runs up to the next
+# one. Dialogue and scenes never span chunks, so each chunk structures
+# on its own, and only sections need the whole script.
+CHUNK_HEADINGS = (SCENE_HEADING, SECTION_HEADING)
+
+NOTE_PLACEHOLDER = re.compile(r"\[\[(\d+)\]\]")
+
+def parse_chunked(lines, args, old, new, engine=None):
+    """Returns the same FTX as parse_fountain, reusing chunks parsed
+    before: old maps the source of chunks to their parsed nodes, and
+    new receives the chunks of this script and its includes. Reused
+    nodes move out of the document that had them."""
+    doc=xml.dom.minidom.getDOMImplementation().createDocument(None, "fountain", None)
+    if args.css:
+        doc.insertBefore(doc.createProcessingInstruction("xml-stylesheet", "href='%s'" % args.css),
+                         doc.documentElement)
+    engine=engine or inline_engine(args.syntax_extensions)
+    title, body = split_title_body(decode_lines(lines))
+    parse_title(title, doc.documentElement, args.meta)
+    parse_inlines(doc, args.semantic_linebreaks, args.syntax_extensions, engine)
+    body, notes = parse_comments_notes(body)
+    sources=args.digests and normalize_sources(body, notes)
+    classified=list(classify_lines(body, args.syntax_extensions))
+    cuts=[n for (n, (tag, _, _)) in enumerate(classified) if n and tag in CHUNK_HEADINGS]
+    for (start, end) in zip([0]+cuts, cuts+[len(body)]):
+        source=body[start:end]
+        key=(tuple(source),
+             tuple(notes[int(i)] for l in source for i in NOTE_PLACEHOLDER.findall(l)),
+             end==len(body))
+        if key in new:
+            # the same chunk again: each copy needs its own nodes
+            chunk=[import_with_sources(doc, n) for n in new[key]]
+        else:
+            chunk=new[key]=old.get(key) or parse_chunk(classified[start:end], notes, args, engine,
+                                                        end<len(body), sources and sources[start:end])
+        for n in chunk:
+            doc.documentElement.appendChild(n)
+    structure_sections(doc)
+    if args.syntax_extensions:
+        process_includes(doc, args, engine,
+                         lambda f, args, engine: parse_chunked(f, args, old, new, engine))
+    if args.digests:
+        # reused chunks keep theirs
+        add_digests(doc, args)
+    return doc
+
+def import_with_sources(doc, n):
+    """Returns a copy of n in doc, which, unlike importNode(), keeps
+    the source lines of n and its descendants."""
+    copy=doc.importNode(n, True)
+    pairs=[(n, copy)]
+    while pairs:
+        (original, c)=pairs.pop()
+        if hasattr(original, "source_lines"):
+            c.source_lines=list(original.source_lines)
+        pairs.extend(zip(original.childNodes, c.childNodes))
+    return copy
+
+def parse_chunk(classified, notes, args, engine, followed, sources=None):
+    doc=xml.dom.minidom.getDOMImplementation().createDocument(None, "fountain", None)
+    last_tag=None
+    for n, (tag, text, extra) in enumerate(classified):
+        e=push_line(doc.documentElement, tag, text, extra, tag==last_tag)
+        if sources:
+            remember_source(e, sources[n])
+        last_tag=tag
+    if followed:
+        # the next chunk's heading would end the last element
+        end_element(doc.documentElement)
+    structure_dialogue(doc)
+    structure_scenes(doc)
+    parse_inlines(doc, args.semantic_linebreaks, args.syntax_extensions, engine)
+    reconstitute_notes(doc, notes)
+    return list(doc.documentElement.childNodes)
+
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+
+class Preview(object):
+    """Keeps FTX of a script up to date with its source and includes.
+    After each update, ops lists the changes from the previous version:
+    replacements of sections and scenes, by their position among
+    sections and scenes in document order, or else a reload."""
+
+    def __init__(self, filename, args):
+        self.filename=filename
+        self.args=args
+        self.engine=inline_engine(args.syntax_extensions)
+        self.chunks={}
+        self.version=0
+        self.ops=[]
+        self.doc=None
+        self.ftx=None
+        self.units=None
+        self.mtimes=None
+        # held while updating; notified after
+        self.changed=threading.Condition()
+        self.update()
+
+    def sources(self):
+        if not self.args.syntax_extensions:
+            return [self.filename]
+        with open(self.filename) as f:
+            return [self.filename]+sorted(find_dependencies(f))
+
+    def update(self):
+        """Reparses if the script or its includes changed since the
+        last update; returns whether they did."""
+        mtimes=dict((p, os.path.exists(p) and os.path.getmtime(p)) for p in self.mtimes or ())
+        if self.mtimes is not None and mtimes==self.mtimes:
+            return False
+        with self.changed:
+            new={}
+            with open(self.filename) as f:
+                doc=parse_chunked(f, updated_args(self.args, infile=f), self.chunks, new, self.engine)
+            self.chunks=new
+            units=preview_units(doc)
+            self.ops=self.units and preview_ops(self.units, units) or [{"op": "reload"}]
+            self.units=units
+            self.doc=doc
+            self.ftx=None
+            self.version+=1
+            self.mtimes=dict((p, os.path.exists(p) and os.path.getmtime(p)) for p in self.sources())
+            self.changed.notify_all()
+        return True
+
+    def document(self):
+        """Returns the current version and its FTX, with the script
+        that keeps the page up to date."""
+        with self.changed:
+            if self.ftx is None:
+                self.ftx=preview_document(self.doc, self.version)
+            return self.version, self.ftx
+
+    def watch(self, interval=0.5):
+        while True:
+            time.sleep(interval)
+            try:
+                self.update()
+            except IOError:
+                # saving in progress; try again next time
+                pass
+
+def preview_units(doc):
+    """Returns (element, parent position, digest) for the document
+    element and each section and scene, in document order, like
+    revision_units(). Scenes come from chunks and keep their digests
+    while their chunks do; sections are new every time."""
+    units=[]
+    def visit(e, parent):
+        digest=getattr(e, "preview_digest", None) or unit_digest(e)
+        if e.nodeName=="scene":
+            e.preview_digest=digest
+        units.append((e, parent, digest))
+        # scenes don't nest
+        if e.nodeName!="scene":
+            position=len(units)-1
+            for c in e.childNodes:
+                if c.nodeName in UNITS:
+                    visit(c, position)
+    visit(doc.documentElement, None)
+    return units
+
+def preview_ops(old, new):
+    outline=lambda units: [(e.nodeName, parent) for (e, parent, _) in units]
+    if outline(old)!=outline(new) or old[0][2]!=new[0][2]:
+        return [{"op": "reload"}]
+    ops=[]
+    replaced=set()
+    for (n, (e, parent, digest)) in enumerate(new[1:], 1):
+        if parent in replaced:
+            # replacing the parent took care of this one
+            replaced.add(n)
+        elif digest!=old[n][2]:
+            replaced.add(n)
+            ops.append({"op": "replace", "unit": n-1,
+                        "xml": serialize(e).decode("utf-8")})
+    return ops
+
+PREVIEW_SCRIPT = """
+(function () {
+    var XHTML = "http://www.w3.org/1999/xhtml";
+    var script = document.getElementsByTagNameNS(XHTML, "script")[0];
+    var events = new EventSource("/events?version=" + script.getAttribute("data-version"));
+    events.onmessage = function (message) {
+        var patch = JSON.parse(message.data);
+        var units = document.querySelectorAll("section, scene");
+        patch.ops.forEach(function (op) {
+            if (op.op == "reload") {
+                events.close();
+                location.reload();
+            } else if (op.op == "replace") {
+                var e = new DOMParser().parseFromString(op.xml, "application/xml").documentElement;
+                units[op.unit].parentNode.replaceChild(document.importNode(e, true), units[op.unit]);
+            }
+        });
+    };
+})();
+"""
+
+class PreviewServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, preview):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PreviewHandler)
+        self.preview=preview
+
+class PreviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the FTX with a script that listens for changes on
+    /events, a stream of server-sent events, and stylesheets from the
+    script's directory or fountainhead's."""
+
+    def do_GET(self):
+        url=urlparse.urlparse(self.path)
+        preview=self.server.preview
+        if url.path=="/":
+            self.send_content("application/xml", preview.document()[1])
+        elif url.path=="/preview.js":
+            self.send_content("application/javascript", PREVIEW_SCRIPT)
+        elif url.path=="/events":
+            query=urlparse.parse_qs(url.query)
+            self.send_events(preview, int(query.get("version", ["0"])[0]))
+        elif url.path.endswith(".css"):
+            for d in (os.path.dirname(preview.filename), os.path.dirname(__file__)):
+                d=os.path.abspath(d)
+                path=os.path.normpath(os.path.join(d, url.path.lstrip("/")))
+                # nothing from outside d
+                if path.startswith(os.path.join(d, "")) and os.path.isfile(path):
+                    with open(path) as f:
+                        return self.send_content("text/css", f.read())
+            self.send_error(404)
+        else:
+            self.send_error(404)
+
+    def send_content(self, content_type, content):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type+"; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_events(self, preview, version):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                with preview.changed:
+                    if preview.version==version:
+                        preview.changed.wait(15)
+                    if preview.version==version:
+                        # keep the connection alive, and find out if it isn't
+                        data=None
+                    else:
+                        ops=preview.ops if preview.version==version+1 else [{"op": "reload"}]
+                        version=preview.version
+                        data=json.dumps({"version": version, "ops": ops})
+                self.wfile.write(data and "data: %s\n\n" % data or ":\n\n")
+                self.wfile.flush()
+        except socket.error:
+            pass
+
+def preview_document(doc, version):
+    script=doc.createElementNS(XHTML_NS, "script")
+    script.setAttribute("xmlns", XHTML_NS)
+    script.setAttribute("src", "/preview.js")
+    script.setAttribute("data-version", str(version))
+    doc.documentElement.appendChild(script)
+    try:
+        s=io.BytesIO()
+        write_ftx(doc, s)
+        return s.getvalue()
+    finally:
+        doc.documentElement.removeChild(script)
+
+
+# Parallel parsing
+
+# With -j, the body of a script parses in the chunks that preview
+# reparses: classification needs no tree, so a pass over the lines
+# finds the scene and section headings to cut at. Worker processes
+# parse batches of chunks and send back their nodes as nested tuples,
+# which pickle without following sibling links, and sections
+# structure over the joined result as usual.
+
+# lines per batch, at least: smaller batches cost more than they save
+BATCH_LINES = 500
+
+def parse_parallel(body, notes, sources, fountain, args):
+    """Appends the structured elements of body to fountain, as
+    parse_body() and the passes after it would, parsing chunks on up
+    to args.jobs processes."""
+    classified=list(classify_lines(body, args.syntax_extensions))
+    cuts=[n for (n, (tag, _, _)) in enumerate(classified) if n and tag in CHUNK_HEADINGS]
+    size=max(BATCH_LINES, len(body)//(4*args.jobs))
+    options=argparse.Namespace(semantic_linebreaks=args.semantic_linebreaks,
+                               syntax_extensions=args.syntax_extensions)
+    batches=[]
+    for (start, end) in zip([0]+cuts, cuts+[len(body)]):
+        if not batches or start-batch_start>=size:
+            batches.append(([], {}, options))
+            batch_start=start
+        chunks, batch_notes, _ = batches[-1]
+        # workers number source lines rather than copy them back
+        chunks.append((classified[start:end], sources and xrange(start, end), end<len(body)))
+        for l in body[start:end]:
+            for i in NOTE_PLACEHOLDER.findall(l):
+                batch_notes[int(i)]=notes[int(i)]
+    if len(batches)>1:
+        pool=multiprocessing.Pool(min(args.jobs, len(batches)))
+        try:
+            results=pool.map(parse_batch, batches, chunksize=1)
+        finally:
+            pool.terminate()
+    else:
+        results=map(parse_batch, batches)
+    doc=ownerDocument(fountain)
+    for nodes in results:
+        for t in nodes:
+            fountain.appendChild(tuple_node(doc, t, sources))
+
+def parse_batch(batch):
+    chunks, notes, args = batch
+    engine=inline_engine(args.syntax_extensions)
+    return [node_tuple(n)
+            for (classified, sources, followed) in chunks
+            for n in parse_chunk(classified, notes, args, engine, followed, sources)]
+
+def node_tuple(n):
+    if n.nodeType==n.TEXT_NODE:
+        return n.data
+    return (n.tagName, n.attributes.items(), [node_tuple(c) for c in n.childNodes],
+            getattr(n, "source_lines", None))
+
+def tuple_node(doc, t, sources):
+    if isinstance(t, basestring):
+        return doc.createTextNode(t)
+    tag, attributes, children, source_lines = t
+    e=doc.createElement(tag)
+    for (name, value) in attributes:
+        e.setAttribute(name, value)
+    for c in children:
+        e.appendChild(tuple_node(doc, c, sources))
+    if source_lines is not None:
+        e.source_lines=[sources[n] for n in source_lines]
+    return e
 
 
 # Dependencies
 
 def find_dependencies(infile):
-    deps=set()
+    return set(included_files(infile))
+
+def included_files(infile, deps=None):
+    """Returns the files infile includes, and the files they include,
+    in the order the includes come."""
+    deps=deps if deps is not None else []
     for l in infile:
         # consider abstracting .rstrip("\r\n"), etc. into a function
         # that both find_dependencies and parse_fountain can use
         if l.startswith("=<"):
-            f,_=filename_fragment(l[2:].rstrip("\r\n"), infile.name)
-            deps.add(f)
+            f,fragment_id=filename_fragment(l[2:].rstrip("\r\n"), infile.name)
+            if l.startswith("=<#"):
+                try:
+                    f=resolve_id(fragment_id, infile.name)[0]
+                except RegistryError:
+                    continue
+            if f in deps:
+                continue
+            deps.append(f)
             try:
-                i=open(f)
-                deps |= find_dependencies(i)
+                with open(f) as i:
+                    included_files(i, deps)
             except IOError:
                 pass
     return deps
 
 def make_rule(args):
-    target_filename=os.path.splitext(args.infile.name)[0]+".ftx"
+    basename=os.path.splitext(args.infile.name)[0]
+    targets=(basename+".ftx", basename+".plot-summary")
     deps=find_dependencies(args.infile)
     if deps:
-        return target_filename + ": " + " ".join(deps)
+        return " ".join(targets) + ": " + " ".join(deps)
     else:
         return ""
 
 
+# Sides
+
+def sides(filename, scene_ids, args):
+    """Returns FTX of the title page of a script and the scenes with
+    these ids, in this order, wherever the script or its includes have
+    them, and the ids it didn't find as scenes. Only the scenes' own
+    lines parse where a scan of the text can find them."""
+    with open(filename) as f:
+        doc=parse_fountain(f, updated_args(args, only=[TITLE_PAGE]))
+        f.seek(0)
+        files=[filename]+(included_files(f) if args.syntax_extensions else [])
+    lines={}
+    parsed={}
+    missing=[]
+    for scene_id in scene_ids:
+        for path in files:
+            if path not in lines:
+                try:
+                    with open(path) as f:
+                        lines[path]=f.readlines()
+                except IOError:
+                    lines[path]=[]
+            marker="#%s#" % scene_id.encode("utf-8")
+            if not any(l.rstrip().endswith(marker) for l in lines[path]):
+                continue
+            file_args=updated_args(args, infile=argparse.Namespace(name=path))
+            scene=parse_fragment(lines[path], scene_id, file_args)
+            if not scene:
+                # the scan can't tell; parse it all, once
+                if path not in parsed:
+                    parsed[path]=parse_fountain(lines[path], file_args)
+                scene=findElementByAttributeValue(parsed[path], "id", scene_id)
+                scene=scene and scene.cloneNode(True)
+            # not a section with the id
+            if scene and scene.nodeName=="scene":
+                doc.documentElement.appendChild(scene)
+                break
+        else:
+            missing.append(scene_id)
+    return doc, missing
+
+
+# Build
+
+# fountainhead.py build does what fountainhead.mk does for .ftx,
+# .plot-summary, .pdf and -bd.pdf, without make: it parses each
+# script once for both its FTX and plot summary, and remembers in
+# BUILD_STATE the content hashes each target was built from, along
+# with the includes the parse actually opened. A target is rebuilt
+# when those hashes change or the target isn't what was built.
+# Scripts build on a pool of threads, and a script's PDFs render at
+# the same time.
+
+BUILD_STATE = ".fountainhead-build.json"
+
+BUILD_TARGETS = ("ftx", "plot-summary", "pdf", "bd-pdf")
+
+FOUNTAINHEAD_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def file_digest(path):
+    """Returns the SHA-1 of a file's content, or None if it's missing."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+class BuildError(Exception):
+    pass
+
+class Build(object):
+    """Brings targets of scripts up to date."""
+
+    def __init__(self, args):
+        self.args=args
+        self.targets=set(args.targets)
+        if self.targets & set(("pdf", "bd-pdf")):
+            # PDFs render from FTX
+            self.targets.add("ftx")
+        try:
+            with open(args.state) as f:
+                self.state=json.load(f)
+        except (IOError, ValueError):
+            self.state={}
+        self.lock=threading.Lock()
+        self.built=[]
+        self.failed=[]
+
+    def run(self, sources):
+        """Builds sources; returns the targets that failed."""
+        pool=multiprocessing.pool.ThreadPool(max(1, self.args.jobs))
+        try:
+            pool.map(self.build_source, sources, chunksize=1)
+        finally:
+            pool.terminate()
+        with open(self.args.state, "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True, separators=(",", ": "))
+        return self.failed
+
+    def build_source(self, source):
+        try:
+            self.build_targets(source)
+        except BuildError as e:
+            with self.lock:
+                self.failed.append(source)
+            print >>sys.stderr, "%s: %s" % (source, e)
+
+    def build_targets(self, source):
+        base=os.path.splitext(source)[0]
+        paths={"ftx": base+".ftx", "plot-summary": base+".plot-summary",
+               "pdf": base+".pdf", "bd-pdf": base+"-bd.pdf"}
+        with self.lock:
+            state=self.state.setdefault(os.path.normpath(source), {"includes": [], "targets": {}})
+        key=self.source_key(source, state["includes"])
+        if any(not self.fresh(state, paths[t], key) for t in ("ftx", "plot-summary") if t in self.targets):
+            # the pool is for PDFs; each parse is on one process
+            args=updated_args(self.args, included=[], jobs=1)
+            if "ftx" in self.targets and not args.css:
+                args.css=os.path.relpath(os.path.join(FOUNTAINHEAD_DIR, "ftx.css"), os.path.dirname(source) or os.curdir)
+            with open(source) as f:
+                doc=parse_fountain(f, updated_args(args, infile=f))
+            state["includes"]=sorted(set(os.path.normpath(i) for i in args.included))
+            key=self.source_key(source, state["includes"])
+            if "ftx" in self.targets:
+                self.make(state, paths["ftx"], key, lambda out: write_ftx(doc, out) or out.write("\n"),
+                          self.args.check and self.check)
+            if "plot-summary" in self.targets:
+                self.make(state, paths["plot-summary"], key,
+                          lambda out: out.write(summarize(doc).encode("utf-8")))
+        # PDFs are as fresh as the FTX, stylesheets and commands they come from
+        renders=[]
+        for (t, stylesheets) in (("pdf", ("ftx.css",)), ("bd-pdf", ("ftx.css", "ftx-bd.css"))):
+            if t not in self.targets:
+                continue
+            command=self.args.weasyprint.split()
+            for css in stylesheets:
+                command+=["-s", os.path.join(FOUNTAINHEAD_DIR, css)]
+            command+=[paths["ftx"], paths[t]]
+            h=hashlib.sha1(" ".join(command)+"\n")
+            for p in [paths["ftx"]]+[os.path.join(FOUNTAINHEAD_DIR, css) for css in stylesheets]:
+                h.update("%s\n" % file_digest(p))
+            if not self.fresh(state, paths[t], h.hexdigest()):
+                renders.append((paths[t], h.hexdigest(), self.start(command)))
+        errors=[]
+        for (path, key, process) in renders:
+            output=process.communicate()[0]
+            if process.returncode:
+                errors.append("%s: %s" % (path, output.strip()))
+            else:
+                self.record(state, path, key)
+        if errors:
+            raise BuildError("; ".join(errors))
+
+    def source_key(self, source, includes):
+        h=hashlib.sha1("s=%d x=%d d=%d P=%d css=%s meta=%r check=%d\n" % (
+            bool(self.args.semantic_linebreaks), bool(self.args.syntax_extensions),
+            bool(self.args.digests), bool(self.args.paginate), self.args.css,
+            self.args.meta, self.args.check))
+        for p in [source]+includes:
+            h.update("%s %s\n" % (p, file_digest(p)))
+        return h.hexdigest()
+
+    def fresh(self, state, path, key):
+        """Whether path was built from key and hasn't changed since."""
+        built=state["targets"].get(path)
+        if not built or built[0]!=key:
+            return False
+        try:
+            st=os.stat(path)
+        except OSError:
+            return False
+        return [st.st_size, st.st_mtime]==built[1:]
+
+    def record(self, state, path, key):
+        st=os.stat(path)
+        with self.lock:
+            state["targets"][path]=[key, st.st_size, st.st_mtime]
+            self.built.append(path)
+
+    def make(self, state, path, key, write, check=None):
+        """Writes a target unless it's fresh; it replaces the old one
+        only once write() and check() succeed."""
+        if self.fresh(state, path, key):
+            return
+        with open(path+"_", "wb") as out:
+            write(out)
+        try:
+            if check:
+                check(path+"_")
+        except BuildError:
+            os.remove(path+"_")
+            raise
+        os.rename(path+"_", path)
+        self.record(state, path, key)
+
+    def check(self, path):
+        """Validates FTX against ftx.dtd, and spellchecks it, as
+        fountainhead.mk does."""
+        validate=self.start([self.args.xmllint, "--noout", "--dtdvalid",
+                             os.path.join(FOUNTAINHEAD_DIR, "ftx.dtd"), path])
+        try:
+            spell=self.start([self.args.aspell, "list", "-H", "-p", self.args.dict], subprocess.PIPE)
+        except BuildError:
+            validate.communicate()
+            raise
+        with open(path, "rb") as f:
+            words=spell.communicate(f.read())[0].split()
+        output=validate.communicate()[0]
+        if validate.returncode:
+            raise BuildError("invalid FTX: %s" % output.strip())
+        if spell.returncode:
+            raise BuildError("aspell failed")
+        if words:
+            raise BuildError("not in dictionary: %s" % " ".join(sorted(set(words))))
+
+    def start(self, command, stdin=None):
+        try:
+            return subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise BuildError("%s: %s" % (command[0], e.strerror))
+
+
 # Command-line invocation
 
-def arg_parser():
-    ap=argparse.ArgumentParser(description="Convert Fountain input to XML.")
+INDEX = "fountainhead.db"
+
+def parse_options():
+    """Options that control parsing, common to all commands."""
+    ap=argparse.ArgumentParser(add_help=False)
     ap.add_argument("-s", "--semantic-linebreaks",
                     action="store_true",
                     help="treat single line breaks as space characters")
     ap.add_argument("-c", "--css",
                     metavar="uri",
                     help="use this CSS stylesheet")
-    ap.add_argument("-f", "--flat-output",
-                    action="store_true",
-                    help="output flat XML without hierarchical structure")
     ap.add_argument("-m", "--meta",
                     action="append", nargs=2, metavar=("key", "value"),
                     help="add metadata values to title page")
     ap.add_argument("-x", "--syntax-extensions",
                     action="store_true",
                     help="interpert =<include.fountain fountainhead extexsion")
+    ap.add_argument("-d", "--digests",
+                    action="store_true",
+                    help="add digest attributes to sections, scenes and dialogue")
+    # included, if a list, receives the names of the files that
+    # includes open, nested ones too
+    ap.set_defaults(flat_output=False, only=None, paginate=False, jobs=1, included=None,
+                    xinclude=False, xincluded=None)
+    return ap
+
+def arg_parser():
+    ap=argparse.ArgumentParser(description="Convert Fountain input to XML.",
+                               parents=[parse_options()])
+    ap.add_argument("-f", "--flat-output",
+                    action="store_true",
+                    help="output flat XML without hierarchical structure")
+    ap.add_argument("-o", "--only",
+                    type=element_types, metavar="type[,type...]",
+                    help="keep only these element types: %s" % ", ".join(PROJECTABLE))
+    ap.add_argument("-j", "--jobs",
+                    type=int, metavar="n",
+                    help="parse chunks of large scripts on n processes")
+    ap.add_argument("--xinclude",
+                    action="store_true",
+                    help="with -x, write included files' FTX next to them and refer to it with xi:include")
+    ap.add_argument("-P", "--paginate",
+                    action="store_true",
+                    help="add page ranges and lengths in eighths of a page to scenes")
+    ap.add_argument("-p", "--plot-summary",
+                    action="store_true",
+                    help="output markdown plot summary instead of XML")
+    ap.add_argument("--format",
+                    choices=("xml", "jsonl", "sqlite"), default="xml",
+                    help="output FTX as XML (default) or as JSON Lines events, or write tables to the --database")
+    ap.add_argument("--database",
+                    metavar="file.db",
+                    help="SQLite database for --format sqlite; a script's rows replace its old ones")
+    ap.add_argument("--shards",
+                    metavar="dir",
+                    help="write one FTX file per top-level section or scene into dir, with a manifest")
+    ap.add_argument("--sidecar",
+                    metavar="file.ftx.idx",
+                    help="also write where each section and scene starts in the output, and its length, for FtxIndex")
+    ap.add_argument("--breakdown",
+                    metavar="dir",
+                    help="write breakdown sheets for each scene and an index of breakdown elements into dir, as CSV and JSON")
+    ap.add_argument("--cast-matrix",
+                    metavar="dir",
+                    help="write which characters appear, and how many lines they speak, in each scene of this script and its includes "
+                    "into dir, as CSV and JSON, replacing dir's old matrix")
+    ap.add_argument("--stripboard",
+                    metavar="dir",
+                    help="write a strip for each scene, with its setting, location, time of day, cast and length, "
+                    "to the stripboard in dir, as CSV and JSON, replacing this script's old strips")
     ap.add_argument("-M", "--dependencies",
                     action="store_true",
                     help="output a make(1) rule describing the dependencies for this file")
@@ -687,14 +3381,257 @@ def arg_parser():
                     default=sys.stdin)
     return ap
 
+def element_types(value):
+    types=value.split(",")
+    for t in types:
+        if t not in PROJECTABLE:
+            raise argparse.ArgumentTypeError("unknown element type: %s" % t)
+    return types
+
+def updated_args(args, **changes):
+    """Returns a copy of args with some values changed."""
+    args=argparse.Namespace(**vars(args))
+    for name, value in changes.items():
+        setattr(args, name, value)
+    return args
+
+def diff_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py diff",
+                               description="Output FTX of the new draft, with revised attributes on what changed since the old one.",
+                               parents=[parse_options()])
+    ap.add_argument("old", metavar="old.fountain",
+                    type=argparse.FileType("r"))
+    ap.add_argument("new", metavar="new.fountain",
+                    type=argparse.FileType("r"))
+    return ap
+
+def diff_main(argv):
+    args=diff_arg_parser().parse_args(argv)
+    old_doc=parse_fountain(args.old, updated_args(args, infile=args.old))
+    new_doc=parse_fountain(args.new, updated_args(args, infile=args.new))
+    write_ftx(diff_drafts(old_doc, new_doc), sys.stdout)
+    sys.stdout.write("\n")
+
+def index_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py index",
+                               description="Add scripts to a full-text index, reparsing only those that changed.",
+                               parents=[parse_options()])
+    ap.add_argument("-i", "--index",
+                    metavar="file", default=INDEX,
+                    help="index database (default %s)" % INDEX)
+    ap.add_argument("paths", metavar="file.fountain", nargs="+")
+    return ap
+
+def index_main(argv):
+    args=index_arg_parser().parse_args(argv)
+    for p in index_scripts(args.index, args.paths, args):
+        print "indexed", p
+
+def ids_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py ids",
+                               description="Register the ids of scenes and sections in the scripts under a directory, "
+                               "so =<#id includes them; report ids that more than one script has.")
+    ap.add_argument("directory", nargs="?", default=os.curdir,
+                    help="project directory (default the current one)")
+    return ap
+
+def ids_main(argv):
+    args=ids_arg_parser().parse_args(argv)
+    registry=os.path.join(args.directory, IDS)
+    for p in update_registry(registry):
+        print "scanned", p
+    duplicates=duplicate_ids(registry)
+    for (fragment_id, paths) in duplicates.items():
+        print >>sys.stderr, "duplicate id #%s# in %s" % (fragment_id.encode("utf-8"), ", ".join(paths))
+
+def build_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py build",
+                               description="Bring .ftx, .plot-summary, .pdf and -bd.pdf files up to date with scripts and their includes, "
+                               "rebuilding only what changed.",
+                               parents=[parse_options()])
+    ap.add_argument("-t", "--targets",
+                    type=lambda s: s.split(","), default=BUILD_TARGETS,
+                    metavar="target[,target...]",
+                    help="build only these: %s" % ", ".join(BUILD_TARGETS))
+    ap.add_argument("-j", "--jobs",
+                    type=int, default=multiprocessing.cpu_count(), metavar="n",
+                    help="build n scripts at a time (default %d)" % multiprocessing.cpu_count())
+    ap.add_argument("--no-check",
+                    dest="check", action="store_false",
+                    help="don't validate or spellcheck FTX")
+    ap.add_argument("--state",
+                    metavar="file", default=BUILD_STATE,
+                    help="where to remember what was built (default %s)" % BUILD_STATE)
+    ap.add_argument("--xmllint", default="xmllint", metavar="command")
+    ap.add_argument("--aspell", default="aspell", metavar="command")
+    ap.add_argument("--dict", default="./aspell.en.pws", metavar="file",
+                    help="aspell personal dictionary (default ./aspell.en.pws)")
+    ap.add_argument("--weasyprint", default="python3 -m weasyprint", metavar="command")
+    ap.add_argument("sources", metavar="file.fountain", nargs="+")
+    return ap
+
+def build_main(argv):
+    ap=build_arg_parser()
+    args=ap.parse_args(argv)
+    unknown=set(args.targets)-set(BUILD_TARGETS)
+    if unknown:
+        ap.error("unknown targets: %s" % ", ".join(sorted(unknown)))
+    build=Build(args)
+    failed=build.run(args.sources)
+    for p in build.built:
+        print "built", p
+    if failed:
+        sys.exit(1)
+
+def sides_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py sides",
+                               description="Output FTX of the title page and some scenes of a script, parsing only those.",
+                               parents=[parse_options()])
+    ap.add_argument("infile", metavar="file.fountain")
+    ap.add_argument("--scenes",
+                    type=lambda s: s.decode("utf-8").split(","), required=True,
+                    metavar="id[,id...]",
+                    help="ids of the scenes, in the order to output them")
+    ap.set_defaults(css="ftx.css")
+    return ap
+
+def sides_main(argv):
+    args=sides_arg_parser().parse_args(argv)
+    doc, missing = sides(args.infile, args.scenes, args)
+    for scene_id in missing:
+        print >>sys.stderr, "%s: no scene #%s#" % (args.infile, scene_id.encode("utf-8"))
+    write_ftx(doc, sys.stdout)
+    sys.stdout.write("\n")
+
+def stats_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py stats",
+                               description="Report words by character and scene, settings, times of day and runtime "
+                               "of scripts, and of all of them together.",
+                               parents=[parse_options()])
+    ap.add_argument("--format",
+                    choices=("json", "csv"), default="json",
+                    help="output JSON (default), or CSV rows of script, measure, key and value")
+    ap.add_argument("-j", "--jobs",
+                    type=int, default=1, metavar="n",
+                    help="parse scripts on n processes")
+    ap.add_argument("paths", metavar="file.fountain", nargs="+")
+    return ap
+
+def stats_main(argv):
+    args=stats_arg_parser().parse_args(argv)
+    reports=corpus_stats(args.paths, args)
+    if args.format=="csv":
+        write_stats_csv(reports, sys.stdout)
+    else:
+        json.dump(reports, sys.stdout, indent=2, separators=(",", ": "))
+        sys.stdout.write("\n")
+
+def search_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py search",
+                               description="Find text elements containing all the words, without reading the scripts.")
+    ap.add_argument("-i", "--index",
+                    metavar="file", default=INDEX,
+                    help="index database (default %s)" % INDEX)
+    ap.add_argument("-n", "--character",
+                    help="only this character's dialogue")
+    ap.add_argument("-e", "--element",
+                    choices=INDEXED+("bd",),
+                    help="only this element type")
+    ap.add_argument("--setting",
+                    help="only scenes with this setting, e.g. EXT")
+    ap.add_argument("--location",
+                    help="only scenes whose location contains this")
+    ap.add_argument("--tod",
+                    help="only scenes at this time of day, e.g. NIGHT")
+    ap.add_argument("--class", dest="bd_class",
+                    help="only breakdown markup of this class")
+    ap.add_argument("words", metavar="word", nargs="*")
+    return ap
+
+def search_main(argv):
+    args=search_arg_parser().parse_args(argv)
+    words=[w.decode("utf-8") for w in args.words]
+    for (path, scene, scene_id, element, character, text) in search_index(
+            args.index, words, args.character, args.element,
+            args.setting, args.location, args.tod, args.bd_class):
+        where=scene_id and "#"+scene_id or scene and "scene %d" % scene or "-"
+        line=u"\t".join((os.path.relpath(path), where, element, character or u"",
+                         u" ".join(text.split())))
+        print line.encode("utf-8")
+
+def preview_arg_parser():
+    ap=argparse.ArgumentParser(prog="fountainhead.py preview",
+                               description="Serve FTX of a script on localhost, updating the page in place whenever the script or its includes change.",
+                               parents=[parse_options()])
+    ap.add_argument("-p", "--port",
+                    type=int, default=8000,
+                    help="port to listen on (default 8000)")
+    ap.add_argument("-i", "--interval",
+                    type=float, default=0.5,
+                    help="seconds between checks for changes (default 0.5)")
+    ap.add_argument("infile", metavar="file.fountain")
+    ap.set_defaults(css="ftx.css")
+    return ap
+
+def preview_main(argv):
+    args=preview_arg_parser().parse_args(argv)
+    preview=Preview(args.infile, args)
+    server=PreviewServer(("localhost", args.port), preview)
+    watcher=threading.Thread(target=preview.watch, args=(args.interval,))
+    watcher.daemon=True
+    watcher.start()
+    print "previewing %s at http://localhost:%d/" % (args.infile, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+# subcommands; without one, fountainhead.py converts a single file
+COMMANDS = {
+    "build": build_main,
+    "diff": diff_main,
+    "ids": ids_main,
+    "index": index_main,
+    "preview": preview_main,
+    "search": search_main,
+    "sides": sides_main,
+    "stats": stats_main,
+}
+
 def main(argv):
-    args=arg_parser().parse_args()
+    if len(argv)>1 and argv[1] in COMMANDS:
+        return COMMANDS[argv[1]](argv[2:])
+    ap=arg_parser()
+    args=ap.parse_args(argv[1:])
+    if args.format=="sqlite" and not (args.database and args.infile is not sys.stdin):
+        ap.error("--format sqlite needs --database and a file.fountain")
 
     if args.dependencies:
         print make_rule(args)
+    elif args.plot_summary:
+        sys.stdout.write(plot_summary(args.infile, args).encode("utf-8"))
+    elif args.shards:
+        write_shards(parse_fountain(args.infile, args), args.shards)
+    elif args.breakdown:
+        write_breakdown(parse_fountain(args.infile, args), args.breakdown)
+    elif args.cast_matrix:
+        write_cast_matrix(parse_fountain(args.infile, args), args.cast_matrix)
+    elif args.stripboard:
+        write_stripboard(parse_fountain(args.infile, updated_args(args, paginate=True)),
+                         args.infile.name, args.stripboard)
+    elif args.format=="jsonl":
+        write_events(parse_fountain(args.infile, args), sys.stdout)
+    elif args.format=="sqlite":
+        write_database(args.database, args.infile.name, args)
+    elif args.sidecar:
+        offsets=[]
+        size=write_ftx(parse_fountain(args.infile, args), sys.stdout, offsets=offsets)
+        sys.stdout.write("\n")
+        with open(args.sidecar, "w") as f:
+            write_sidecar(offsets, size+1, f)
     else:
-        #print pprint(parse_fountain(args.infile, args))
-        print parse_fountain(args.infile, args).toxml().encode('utf-8')
+        write_ftx(parse_fountain(args.infile, args), sys.stdout)
+        sys.stdout.write("\n")
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -5,6 +5,11 @@ import pytest
 import glob
 import os
 import re
+import io
+import json
+import xml.dom.minidom
+import threading
+import urllib2
 
 DEFAULT_ARGS = fountainhead.arg_parser().parse_args("")
 SEMANTIC_LINES = fountainhead.arg_parser().parse_args(["-s",])
@@ -1153,3 +1158,1107 @@ def test_file_sample(f):
     args = fountainhead.arg_parser().parse_args(arg_list)
     xml = open(f).read()
     assert fountainhead.pprint(fountainhead.parse_fountain(args.infile, args)).strip() == xml.strip()
+
+
+class TestSerialization:
+    def test_compact(self):
+        doc = fountainhead.parse_fountain("""
+INT. HOUSE - DAY
+
+MARY (O.S.)
+I can't *believe* it.
+""".split("\n"), DEFAULT_ARGS)
+        out = io.BytesIO()
+        fountainhead.write_ftx(doc, out)
+        assert out.getvalue() == '<?xml version="1.0" encoding="utf-8"?><fountain><scene><scene-heading><setting>INT.</setting><location>HOUSE</location><tod>DAY</tod></scene-heading><dialogue><character><name>MARY</name><extension>(O.S.)</extension></character><line>I can\'t <i>believe</i> it.</line></dialogue><action/></scene></fountain>'
+    def test_minidom_untouched(self):
+        # other code in the process keeps minidom's own pretty-printer
+        doc = xml.dom.minidom.parseString("<action>a<b>b</b></action>")
+        assert doc.documentElement.toprettyxml(indent="  ") == "<action>\n  a\n  <b>b</b>\n</action>\n"
+
+class TestEvents:
+    def test_events(self):
+        doc = fountainhead.parse_fountain("""
+INT. HOUSE - DAY #house#
+
+MARY
+I can't *believe* it.
+""".split("\n"), DEFAULT_ARGS)
+        out = io.BytesIO()
+        fountainhead.write_events(doc, out)
+        events = [json.loads(l) for l in out.getvalue().splitlines()]
+        assert events[0] == ["fountain-events", 1]
+        assert events[1:4] == [["open", "fountain"],
+                               ["open", "scene", {"id": "house"}],
+                               ["open", "scene-heading"]]
+        assert ["open", "i"] in events
+        assert events[-1] == ["close", "fountain"]
+    def test_same_as_xml(self):
+        doc = fountainhead.parse_fountain(open(os.path.join(DIR, "tests/example.fountain")), DEFAULT_ARGS)
+        out = io.BytesIO()
+        fountainhead.write_events(doc, out)
+        xml = []
+        for e in [json.loads(l) for l in out.getvalue().splitlines()][1:]:
+            if e[0] == "open":
+                attrs = e[2:] and e[2] or {}
+                xml.append("<" + e[1] + "".join(' %s="%s"' % (k, fountainhead.escape(v)) for k, v in sorted(attrs.items())) + ">")
+            elif e[0] == "text":
+                xml.append(fountainhead.escape(e[1]))
+            else:
+                xml.append("</" + e[1] + ">")
+        out = io.BytesIO()
+        fountainhead.write_ftx(doc.documentElement, out)
+        assert "".join(xml) == re.sub(r"<([\w-]+)/>", r"<\1></\1>", out.getvalue())
+
+class TestDigests:
+    ft = """
+# ACT I
+
+INT. HOUSE - DAY
+
+MARY
+Hello. [[a note]]
+
+EXT. STREET - NIGHT
+
+Tom runs.
+"""
+    def digests(self, ft, argv=[]):
+        args = fountainhead.arg_parser().parse_args(["-d"]+argv)
+        doc = fountainhead.parse_fountain(ft.split("\n"), args)
+        return [(e.nodeName, e.getAttribute("digest")) for e in doc.getElementsByTagName("*")
+                if e.getAttribute("digest")]
+    def test_units(self):
+        assert [n for n, d in self.digests(self.ft)] == ["section", "scene", "dialogue", "scene"]
+    def test_stable(self):
+        # the digest must not change between runs, versions of python
+        # or machines
+        assert self.digests("INT. HOUSE - DAY\n\nMary sits.") == [
+            ("scene", "f31eafbb5af554ed95db0964799a07d6d2d17731")]
+        assert self.digests(self.ft) == self.digests(self.ft.replace("\n", "\r\n"))
+    def test_local_changes(self):
+        before = self.digests(self.ft)
+        after = self.digests(self.ft.replace("Tom runs.", "Tom walks."))
+        # the section contains the changed scene
+        assert [b == a for b, a in zip(before, after)] == [False, True, True, False]
+    def test_notes_elsewhere(self):
+        before = self.digests(self.ft)
+        after = self.digests("[[another note]]\n"+self.ft)
+        assert before[-1] == after[-1]
+    def test_options(self):
+        assert self.digests(self.ft) != self.digests(self.ft, ["-s"])
+    def test_no_body(self):
+        assert self.digests("") == []
+        assert self.digests("Title: x\n") == []
+        doc = fountainhead.Parser(digests=True).parse_string("Title: x\n")
+        assert doc.documentElement.firstChild.nodeName == "title-page"
+
+class TestRevisions:
+    old = """
+INT. HOUSE - DAY #house#
+
+MARY
+I can't believe it.
+
+EXT. STREET - NIGHT
+
+Tom runs.
+
+EXT. DOCKS - NIGHT #docks#
+
+Waves.
+"""
+    def diff(self, old, new):
+        doc = fountainhead.diff_drafts(
+            fountainhead.parse_fountain(old.split("\n"), DEFAULT_ARGS),
+            fountainhead.parse_fountain(new.split("\n"), DEFAULT_ARGS))
+        return doc.documentElement
+    def revised(self, e):
+        return [(n.nodeName, n.getAttribute("id"), n.getAttribute("revised"))
+                for n in e.getElementsByTagName("*") if n.getAttribute("revised")]
+    def test_unchanged(self):
+        assert self.revised(self.diff(self.old, self.old)) == []
+    def test_changed_line(self):
+        new = self.old.replace("believe", "*believe*")
+        assert self.revised(self.diff(self.old, new)) == [("scene", "house", "changed"),
+                                                          ("dialogue", "", "changed"),
+                                                          ("line", "", "changed")]
+    def test_changed_scene_without_id(self):
+        new = self.old.replace("Tom runs.", "Tom runs.\n\nTom stops.")
+        assert self.revised(self.diff(self.old, new)) == [("scene", "", "changed"),
+                                                          ("action", "", "changed")]
+    def test_added_and_omitted(self):
+        new = self.old.replace("EXT. DOCKS - NIGHT #docks#\n\nWaves.", "INT. BANK - DAY\n\nQuiet.")
+        e = self.diff(self.old, new)
+        assert self.revised(e) == [("scene", "", "added"), ("scene", "docks", "omitted")]
+        omitted = e.getElementsByTagName("scene")[-1]
+        assert [n.nodeName for n in omitted.childNodes] == ["scene-heading"]
+    def test_omitted_last_in_section(self):
+        old = "# ACT I\n\n" + self.old + "\n# ACT II\n\nINT. BANK - DAY #bank#\n\nQuiet.\n"
+        new = old.replace("EXT. DOCKS - NIGHT #docks#\n\nWaves.", "")
+        e = self.diff(old, new)
+        assert self.revised(e) == [("scene", "docks", "omitted")]
+        act1, act2 = e.getElementsByTagName("section")
+        assert [n.getAttribute("id") for n in act1.childNodes if n.nodeName=="scene"] == ["house", "", "docks"]
+        assert [n.getAttribute("id") for n in act2.childNodes if n.nodeName=="scene"] == ["bank"]
+    def test_omitted_section(self):
+        old = "# ACT I\n\n## Night #night#\n\nEXT. DOCKS - NIGHT #docks#\n\nWaves.\n\n# ACT II\n\nINT. BANK - DAY\n"
+        new = "# ACT I\n\n# ACT II\n\nINT. BANK - DAY\n"
+        e = self.diff(old, new)
+        assert self.revised(e) == [("section", "night", "omitted"), ("scene", "docks", "omitted")]
+        night = fountainhead.findElementByAttributeValue(e, "id", "night")
+        assert night.parentNode.getAttribute("heading") == "ACT I"
+        assert night.lastChild.getAttribute("id") == "docks"
+    def test_scenes_with_ids_dont_pair(self):
+        new = self.old.replace("#docks#", "#pier#")
+        assert self.revised(self.diff(self.old, new)) == [("scene", "pier", "added"),
+                                                          ("scene", "docks", "omitted")]
+
+class TestShards:
+    ft = """
+Title: Brick & Steel
+
+# ACT I
+
+INT. HOUSE - DAY
+
+Mary sits.
+
+CUT TO:
+
+# ACT II
+
+EXT. STREET - NIGHT #street#
+
+Tom runs.
+"""
+    def shards(self, ft, directory):
+        doc = fountainhead.parse_fountain(ft.split("\n"), DEFAULT_ARGS)
+        return fountainhead.write_shards(doc, str(directory))["shards"]
+    def test_shards(self, tmpdir):
+        shards = self.shards(self.ft, tmpdir)
+        assert [s["element"] for s in shards] == ["title-page", "section", "section"]
+        # each shard is a well-formed document; together they make up
+        # the whole
+        parts = [xml.dom.minidom.parse(str(tmpdir.join(s["file"]))).documentElement for s in shards]
+        assert [n.nodeName for p in parts for n in p.childNodes] == ["title-page", "section", "section"]
+        assert parts[1].getElementsByTagName("transition")
+        assert parts[2].getElementsByTagName("scene")[0].getAttribute("id") == "street"
+        assert json.load(tmpdir.join("manifest.json").open())["shards"] == shards
+    def test_incremental(self, tmpdir):
+        before = self.shards(self.ft, tmpdir)
+        after = self.shards(self.ft.replace("Tom runs.", "Tom walks."), tmpdir)
+        assert before[:2] == after[:2]
+        assert before[2]["sha1"] != after[2]["sha1"]
+        # the stale shard is gone
+        assert sorted(os.listdir(str(tmpdir))) == sorted(["manifest.json"] + [s["file"] for s in after])
+
+class TestProjection:
+    ft = """
+Title: Brick & Steel
+
+INT. HOUSE - DAY
+
+Some text.
+
+MARY
+(quietly)
+Hi there.
+
+More text.
+"""
+    def test_scheduling(self):
+        xml = """
+<fountain>
+  <scene>
+    <scene-heading><setting>INT.</setting><location>HOUSE</location><tod>DAY</tod></scene-heading>
+    <dialogue>
+      <character><name>MARY</name></character>
+    </dialogue>
+  </scene>
+</fountain>
+"""
+        assert_transform(self.ft, xml, fountainhead.arg_parser().parse_args(["--only", "scene-heading,character"]))
+    def test_action_stays_separate(self):
+        # dropped dialogue still ends the action paragraph before it
+        xml = """
+<fountain>
+  <scene>
+    <action>Some text.</action>
+    <action>More text.</action>
+  </scene>
+</fountain>
+"""
+        assert_transform(self.ft, xml, fountainhead.arg_parser().parse_args(["--only", "action"]))
+    def test_dialogue_without_character(self):
+        xml = """
+<fountain>
+  <scene>
+    <dialogue>
+      <line>Hi there.</line>
+    </dialogue>
+  </scene>
+</fountain>
+"""
+        assert_transform(self.ft, xml, fountainhead.arg_parser().parse_args(["--only", "line"]))
+    def test_metadata_only(self):
+        def lines():
+            yield "Title: Brick & Steel"
+            yield ""
+            raise AssertionError("read past title page")
+        xml = """
+<fountain>
+  <title-page>
+    <key name="Title">
+      <value>Brick &amp; Steel</value>
+    </key>
+  </title-page>
+</fountain>
+"""
+        doc = fountainhead.parse_fountain(lines(), fountainhead.arg_parser().parse_args(["--only", "title-page"]))
+        assert fountainhead.pprint(doc).strip() == ('<?xml version="1.0" encoding="utf-8"?>'+xml).strip()
+    def test_unknown_type(self):
+        with pytest.raises(SystemExit):
+            fountainhead.arg_parser().parse_args(["--only", "scene"])
+
+class TestPlotSummary:
+    # the expected values are the output of plot-summary.xslt on the
+    # FTX of the same source
+    def test_title_and_sections(self):
+        ft = """
+Title: **BRICK & STEEL**
+Logline: Two cops _retire_.
+Author: Stu Maschwitz
+
+# ACT I
+
+= Set up the characters.
+= And the story.
+
+EXT. BRICK'S PATIO - DAY
+
+= Warm sun, cold beer.
+
+A gorgeous day.
+
+## Sequence
+
+= Nothing to do.
+"""
+        md = """# BRICK & STEEL
+
+Two cops retire.
+
+# Plot Summary
+
+## ACT I
+
+Set up the characters.
+And the story.Warm sun, cold beer.
+
+### Sequence
+
+Nothing to do.
+
+"""
+        assert fountainhead.plot_summary(ft.split("\n"), DEFAULT_ARGS) == md
+    def test_synopses_in_separate_scenes(self):
+        # XSLT separates only sibling synopses with a linefeed
+        ft = """
+INT. HOUSE - DAY
+
+= One.
+
+CUT TO:
+
+= Two.
+"""
+        assert fountainhead.plot_summary(ft.split("\n"), DEFAULT_ARGS) == "# Plot SummaryOne.Two.\n\n"
+    def test_includes(self):
+        args = fountainhead.arg_parser().parse_args(["-xp", os.path.join(DIR, "tests/includes.fountain")])
+        # example.fountain has no synopses; sections.fountain#intro
+        # has no synopses either, but its heading remains
+        md = "# Plot Summary\n\n## sequence with ID\n\n\n\n"
+        assert fountainhead.plot_summary(args.infile, args) == md
+
+class TestFragments:
+    bank = """Title: Scene Bank
+
+[[a note before]]
+
+INT. BANK - DAY #mirror_a#
+
+BRICK [[cue note]]
+Hand it over.
+
+# Later #later#
+
+## Vault #vault#
+
+Steel waits.
+
+EXT. BANK - NIGHT #mirror_b#
+
+Steel runs.
+
+## Street
+
+/*
+INT. NOWHERE - DAY #ghost#
+
+*/
+"""
+    def lines(self):
+        return [l+"\n" for l in self.bank.split("\n")]
+    def full(self, fragment_id):
+        doc = fountainhead.parse_fountain(self.lines(), DEFAULT_ARGS)
+        return fountainhead.findElementByAttributeValue(doc, "id", fragment_id)
+    @pytest.mark.parametrize("fragment_id", ["mirror_a", "vault", "mirror_b"])
+    def test_same_as_whole_file(self, fragment_id):
+        fragment = fountainhead.parse_fragment(self.lines(), fragment_id, DEFAULT_ARGS)
+        assert fountainhead.serialize(fragment) == fountainhead.serialize(self.full(fragment_id))
+    def test_region(self):
+        region, notes_before = fountainhead.fragment_region(self.lines(), u"mirror_a", False)
+        # up to and including the heading that ends it
+        assert region[0] == "INT. BANK - DAY #mirror_a#\n"
+        assert region[-1] == "# Later #later#\n"
+        assert notes_before == 1
+    def test_cannot_tell(self):
+        # a shallower section that follows nests in a deeper one
+        assert fountainhead.fragment_region(["## A #a#\n", "# B\n"], u"a", False) is None
+        # the boneyard hides this one
+        assert fountainhead.fragment_region(self.lines(), u"ghost", False) is None
+    def test_include(self, tmpdir):
+        tmpdir.join("bank.fountain").write(self.bank)
+        f = tmpdir.join("script.fountain")
+        f.write("=<bank.fountain#mirror_b\n\n=<bank.fountain#ghost\n")
+        args = fountainhead.arg_parser().parse_args(["-x", str(f)])
+        doc = fountainhead.parse_fountain(args.infile, args)
+        # no #ghost: the whole bank, but its title page
+        assert [e.nodeName for e in doc.documentElement.childNodes] == ["scene", "action", "scene", "section"]
+        assert fountainhead.serialize(doc.documentElement.firstChild) == fountainhead.serialize(self.full("mirror_b"))
+    def test_xinclude(self, tmpdir):
+        tmpdir.join("bank", "bank.fountain").write(self.bank, ensure=True)
+        tmpdir.join("bank", "intro.fountain").write("Title: Intro\n\nINT. LOBBY - DAY\n\n=<bank.fountain#vault\n")
+        f = tmpdir.join("script.fountain")
+        f.write("=<bank/bank.fountain#mirror_b\n\n=<bank/intro.fountain\n")
+        args = fountainhead.arg_parser().parse_args(["-x", "--xinclude", str(f)])
+        doc = fountainhead.parse_fountain(args.infile, args)
+        refs = [(x.getAttribute("href"), x.getAttribute("xpointer")) for x in doc.documentElement.childNodes]
+        assert refs == [("bank/bank.ftx", "xpointer(//*[@id='mirror_b'])"),
+                        ("bank/intro.ftx", "xpointer(/fountain/node()[not(self::title-page)])")]
+        # nested includes refer to FTX relative to their own file
+        intro = xml.dom.minidom.parse(str(tmpdir.join("bank", "intro.ftx")))
+        assert intro.getElementsByTagName("xi:include")[0].getAttribute("href") == "bank.ftx"
+        bank = xml.dom.minidom.parse(str(tmpdir.join("bank", "bank.ftx")))
+        assert fountainhead.serialize(fountainhead.findElementByAttributeValue(bank, "id", "mirror_b")) == \
+            fountainhead.serialize(self.full("mirror_b"))
+        # FTX newer than its source, from the same options, is left alone
+        tmpdir.join("bank", "bank.ftx").write("<fountain/>")
+        with open(str(f)) as again:
+            fountainhead.parse_fountain(again, args)
+        assert tmpdir.join("bank", "bank.ftx").read() == "<fountain/>"
+        # but not with other options
+        with open(str(f)) as again:
+            fountainhead.parse_fountain(again, fountainhead.updated_args(args, infile=again, digests=True))
+        assert "digest=" in tmpdir.join("bank", "bank.ftx").read()
+    def test_xpointer_string(self):
+        assert fountainhead.xpointer_string(u"vault") == u"'vault'"
+        assert fountainhead.xpointer_string(u"it's") == u'"it\'s"'
+        assert fountainhead.xpointer_string(u'say "(hi)" it\'s^') == \
+            u"""concat('say "^(hi^)" it', "'", 's^^')"""
+
+class TestSides:
+    def test_sides(self, tmpdir):
+        tmpdir.join("bank.fountain").write(TestFragments.bank)
+        f = tmpdir.join("script.fountain")
+        f.write("Title: Brick\n\nEXT. ROOF - DAY #12#\n\nBrick jumps.\n\n=<bank.fountain\n")
+        args = fountainhead.sides_arg_parser().parse_args(["-x", "--scenes", "mirror_b,12,ghost,later", str(f)])
+        doc, missing = fountainhead.sides(args.infile, args.scenes, args)
+        # later is a section
+        assert missing == ["ghost", "later"]
+        assert [e.nodeName for e in doc.documentElement.childNodes] == ["title-page", "scene", "scene"]
+        assert fountainhead.serialize(doc.documentElement.childNodes[1]) == \
+            fountainhead.serialize(TestFragments().full("mirror_b"))
+        assert doc.documentElement.lastChild.getAttribute("id") == "12"
+        assert doc.firstChild.data == "href='ftx.css'"
+
+class TestRegistry:
+    def project(self, tmpdir):
+        tmpdir.join("bank", "bank.fountain").write(TestFragments.bank, ensure=True)
+        tmpdir.join("eps", "one.fountain").write("=<#vault\n\n=<#mirror_a\n", ensure=True)
+        return fountainhead.os.path.join(str(tmpdir), fountainhead.IDS)
+    def include(self, tmpdir, ft):
+        f = tmpdir.join("eps", "one.fountain")
+        f.write(ft)
+        args = fountainhead.arg_parser().parse_args(["-x", str(f)])
+        return fountainhead.parse_fountain(args.infile, args)
+    def test_scan(self, tmpdir):
+        lines = TestFragments().lines()
+        ids = fountainhead.scan_ids(lines)
+        assert [i[0] for i in ids] == ["mirror_a", "later", "vault", "mirror_b"]
+        (_, start, end, notes_before) = ids[0]
+        assert ("".join(lines)[start:end].splitlines(True), notes_before) == \
+            fountainhead.fragment_region(lines, u"mirror_a", True)
+        # a shallower section follows, but the parse confirms it's there
+        assert ids[1][1:] == (None, None, None)
+    def test_include(self, tmpdir):
+        registry = self.project(tmpdir)
+        assert sorted(fountainhead.update_registry(registry)) == ["bank/bank.fountain", "eps/one.fountain"]
+        assert fountainhead.update_registry(registry) == []
+        doc = self.include(tmpdir, "=<#vault\n\n=<#mirror_a\n")
+        assert [e.getAttribute("id") for e in doc.documentElement.childNodes] == ["vault", "mirror_a"]
+        assert fountainhead.serialize(doc.documentElement.lastChild) == \
+            fountainhead.serialize(TestFragments().full("mirror_a"))
+    def test_moved(self, tmpdir):
+        registry = self.project(tmpdir)
+        fountainhead.update_registry(registry)
+        tmpdir.join("bank", "bank.fountain").move(tmpdir.join("eps", "bank.fountain"))
+        doc = self.include(tmpdir, "=<#vault\n")
+        assert doc.documentElement.firstChild.getAttribute("id") == "vault"
+    def test_errors(self, tmpdir):
+        registry = self.project(tmpdir)
+        tmpdir.join("eps", "two.fountain").write("INT. VAULT - NIGHT #vault#\n\nSteel.\n")
+        fountainhead.update_registry(registry)
+        assert fountainhead.duplicate_ids(registry) == {"vault": ["bank/bank.fountain", "eps/two.fountain"]}
+        doc = self.include(tmpdir, "=<#vault\n\n=<#ghost\n")
+        assert fountainhead.textContent(doc.documentElement) == \
+            "#vault: #vault# is in bank/bank.fountain, eps/two.fountain" \
+            "#ghost: no script in %s has #ghost#" % tmpdir
+
+class TestPagination:
+    def paginate(self, ft):
+        args = fountainhead.arg_parser().parse_args(["-P"])
+        doc = fountainhead.parse_fountain(ft.split("\n"), args)
+        return (doc.documentElement.getAttribute("pages"),
+                [(s.getAttribute("pages"), s.getAttribute("eighths")) for s in doc.getElementsByTagName("scene")])
+    def action(self, lines):
+        return "\n".join("Line %d." % n for n in range(lines))
+    def test_short_scenes(self):
+        ft = """
+INT. HOUSE - DAY
+
+Mary sits.
+
+EXT. STREET - NIGHT
+
+Tom runs.
+
+===
+
+INT. CAR - NIGHT
+
+They drive.
+"""
+        assert self.paginate(ft) == ("2", [("1", "1"), ("1", "1"), ("2", "1")])
+    def test_scene_heading_needs_room(self):
+        # heading, blank line and 50 lines of action leave room for
+        # only a blank line and one more
+        ft = "INT. HOUSE - DAY\n\n%s\n\nEXT. STREET - NIGHT\n\nTom runs.\n" % self.action(50)
+        assert self.paginate(ft) == ("2", [("1", "8"), ("2", "1")])
+    def test_dialogue_splits_after_line(self):
+        # 4 lines of room: cue, parenthetical, first line, (MORE)
+        ft = "INT. HOUSE - DAY\n\n%s\n\nMARY\n(softly)\nOne.\nTwo.\n(beat)\nThree.\n" % self.action(48)
+        assert self.paginate(ft) == ("2", [("1-2", "9")])
+    def test_no_orphaned_cue(self):
+        ft = "INT. HOUSE - DAY\n\n%s\n\nMARY\nOne.\nTwo.\nThree.\n" % self.action(50)
+        assert self.paginate(ft) == ("2", [("1-2", "9")])
+    def test_wrapping(self):
+        assert fountainhead.wrapped_lines(u"x"*60, 60, {}) == 1
+        assert fountainhead.wrapped_lines(u"x"*61, 60, {}) == 2
+        assert fountainhead.wrapped_lines(u"word "*12+u"\n\nend", 35, {}) == 4
+        assert fountainhead.wrapped_lines(u"x"*120, 60, {}) == 2
+
+class TestParser:
+    def test_same_as_parse_fountain(self):
+        f = os.path.join(DIR, "tests/example.fountain")
+        expected = fountainhead.pprint(fountainhead.parse_fountain(open(f), DEFAULT_ARGS))
+        parser = fountainhead.Parser()
+        assert fountainhead.pprint(parser.parse_file(f)) == expected
+        assert fountainhead.pprint(parser.parse_string(open(f).read().decode("utf-8"))) == expected
+    def test_include_root(self):
+        f = os.path.join(DIR, "tests/includes.fountain")
+        args = fountainhead.arg_parser().parse_args(["-x", f])
+        expected = fountainhead.pprint(fountainhead.parse_fountain(args.infile, args))
+        parser = fountainhead.Parser(syntax_extensions=True, include_root=os.path.join(DIR, "tests"))
+        assert fountainhead.pprint(parser.parse_string(open(f).read())) == expected
+    def test_threads(self):
+        parser = fountainhead.Parser(syntax_extensions=True, meta=[("Draft", "blue")])
+        ft = "Title: T\n\nINT. HOUSE - DAY\n\nMary holds a [gun](prop \"gun\") and *waits*.\n"
+        expected = fountainhead.pprint(parser.parse_string(ft))
+        results = []
+        def work():
+            for _ in range(20):
+                results.append(fountainhead.pprint(parser.parse_string(ft)))
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [expected] * 80
+
+class TestHooks:
+    ft = """# ACT I
+
+INT. HOUSE - DAY
+
+Mary holds a [gun](prop "gun").
+
+MARY
+Where is it? [[check]]
+
+TOM
+Nowhere.
+"""
+    def test_order(self):
+        events = []
+        hooks = fountainhead.Hooks()
+        for tag in ("section", "scene", "dialogue", "character", "bd", "note"):
+            hooks.add(tag, lambda e: events.append(("open", e.tagName)),
+                      lambda e: events.append(("close", e.tagName)))
+        fountainhead.parse_fountain(self.ft.split("\n"), fountainhead.arg_parser().parse_args(["-x"]), hooks=hooks)
+        # each pass in turn, each in document order
+        assert events == [
+            ("open", "character"), ("close", "character"),
+            ("open", "character"), ("close", "character"),
+            ("open", "dialogue"), ("close", "dialogue"),
+            ("open", "dialogue"), ("close", "dialogue"),
+            ("open", "scene"), ("close", "scene"),
+            ("open", "section"), ("close", "section"),
+            ("open", "bd"), ("close", "bd"),
+            ("open", "note"), ("close", "note")]
+    def test_complete(self):
+        seen = []
+        hooks = fountainhead.Hooks()
+        hooks.add("action", closed=lambda e: seen.append(fountainhead.textContent(e).strip()))
+        hooks.add("scene", closed=lambda e: seen.append(len(e.childNodes)))
+        hooks.add("dual-dialogue", closed=lambda e: seen.append(len(e.getElementsByTagName("dialogue"))))
+        hooks.add("note", closed=lambda e: seen.append(fountainhead.textContent(e)))
+        hooks.add("extension", closed=lambda e: seen.append(fountainhead.textContent(e)))
+        fountainhead.Parser().parse_string(self.ft + "\nMARY (V.O.) ^\nHere.\n\nBoom.\n", hooks=hooks)
+        assert seen == ["Mary holds a [gun](prop \"gun\").", "(V.O.)", "Boom.", 2, 5, "check"]
+    def test_visitor(self):
+        class Lines(object):
+            def __init__(self):
+                self.lines = {}
+            def close_dialogue(self, e):
+                name = fountainhead.textContent(e.getElementsByTagName("name")[0])
+                self.lines[name] = self.lines.get(name, 0) + len(e.getElementsByTagName("line"))
+            def open_scene(self, e):
+                self.heading = fountainhead.textContent(e.firstChild)
+        lines = Lines()
+        hooks = fountainhead.Hooks()
+        hooks.add_visitor(lines)
+        fountainhead.Parser().parse_string(self.ft, hooks=hooks)
+        assert lines.lines == {"MARY": 1, "TOM": 1}
+        assert lines.heading == "INT.HOUSEDAY"
+
+class TestBreakdown:
+    ft = """Mary's [diary](prop) is on the desk.
+
+INT. HOUSE - DAY #house#
+
+Mary holds a [revolver](prop "gun"). She loads the [gun](prop "gun").
+
+A [dog](animal) barks.
+
+EXT. STREET - NIGHT
+
+The [revolver](prop "gun") fires.
+"""
+    def test_sheets(self):
+        sheets = fountainhead.breakdown_sheets(fountainhead.parse_fountain(
+            io.BytesIO(self.ft), fountainhead.arg_parser().parse_args(["-x"])))
+        assert [(s["scene"], s["id"], s["heading"]) for s in sheets] == [
+            (0, None, None), (1, "house", "INT. HOUSE - DAY"), (2, None, "EXT. STREET - NIGHT")]
+        assert [dict(s["elements"]) for s in sheets] == [
+            {"prop": ["diary"]}, {"prop": ["gun"], "animal": ["dog"]}, {"prop": ["gun"]}]
+        index = fountainhead.element_index(sheets)
+        assert index["prop"] == {"diary": [0], "gun": [1, 2]}
+        assert index["animal"] == {"dog": [1]}
+    def test_write(self, tmpdir):
+        f = tmpdir.join("script.fountain")
+        f.write(self.ft)
+        fountainhead.main(["fountainhead", "-x", "--breakdown", str(tmpdir.join("bd")), str(f)])
+        assert sorted(os.listdir(str(tmpdir.join("bd")))) == [
+            "breakdown.csv", "breakdown.json", "elements.csv", "elements.json"]
+        rows = tmpdir.join("bd", "breakdown.csv").read().splitlines()
+        assert rows[0] == "scene,id,heading,pages,eighths," + ",".join(fountainhead.BD_CLASSES)
+        assert rows[2] == "1,house,INT. HOUSE - DAY,,,,,,,,,dog,gun,,,"
+        assert tmpdir.join("bd", "elements.csv").read().splitlines() == [
+            "class,element,scenes", "prop,diary,0", "prop,gun,1 2", "animal,dog,1"]
+        assert json.loads(tmpdir.join("bd", "elements.json").read())["prop"]["gun"] == [1, 2]
+
+class TestCastMatrix:
+    ft = """[Tom](character) waits outside.
+
+INT. HOUSE - DAY #house#
+
+MARY (V.O.)
+Where is it?
+Tell me.
+
+TOM
+Nowhere.
+
+EXT. STREET - NIGHT
+
+[Mary](character) runs.
+
+MARY (CONT'D)
+Stop!
+"""
+    def test_matrix(self):
+        scenes, cast = fountainhead.cast_matrix(ftx(self.ft, fountainhead.arg_parser().parse_args(["-x"])).ownerDocument)
+        assert scenes == [(0, None, None), (1, "house", "INT. HOUSE - DAY"), (2, None, "EXT. STREET - NIGHT")]
+        assert cast == [("TOM", 0b011, {1: 1}), ("MARY", 0b110, {1: 1, 2: 1})]
+    def test_write(self, tmpdir):
+        f = tmpdir.join("script.fountain")
+        f.write(self.ft)
+        fountainhead.main(["fountainhead", "-x", "--cast-matrix", str(tmpdir.join("cast")), str(f)])
+        assert tmpdir.join("cast", "cast.csv").read().splitlines() == [
+            "scene,id,heading,TOM,MARY", "0,,,x,", "1,house,INT. HOUSE - DAY,1,1", "2,,EXT. STREET - NIGHT,,1"]
+        assert json.loads(tmpdir.join("cast", "cast.json").read())["characters"][1] == {
+            "name": "MARY", "scenes": [1, 2], "lines": [1, 1]}
+
+class TestStripboard:
+    ft = """INT. HOUSE - DAY #house#
+
+MARY
+Where is it?
+
+EXT. DOCKS - NIGHT
+
+[Tom](character) waits.
+
+EXT. DOCKS - NIGHT
+
+MARY
+Stop!
+"""
+    def test_write(self, tmpdir):
+        one = tmpdir.join("one.fountain")
+        one.write(self.ft)
+        two = tmpdir.join("two.fountain")
+        two.write("EXT. DOCKS - DAY\n\nTOM\nHere.\n")
+        board = str(tmpdir.join("board"))
+        for f in (one, two, one):
+            fountainhead.main(["fountainhead", "-x", "--stripboard", board, str(f)])
+        # one's strips replaced, in place
+        assert tmpdir.join("board", "stripboard.csv").read().splitlines() == [
+            "episode,scene,id,setting,location,tod,pages,eighths,cast",
+            "%s,1,house,INT.,HOUSE,DAY,1,1,MARY" % one,
+            "%s,2,,EXT.,DOCKS,NIGHT,1,1,TOM" % one,
+            "%s,3,,EXT.,DOCKS,NIGHT,1,1,MARY" % one,
+            "%s,1,,EXT.,DOCKS,DAY,1,1,TOM" % two]
+        assert json.loads(tmpdir.join("board", "stripboard.json").read())["indexes"]["location"] == {
+            "DOCKS": [1, 2, 3], "HOUSE": [0]}
+    def test_select(self, tmpdir):
+        strips = fountainhead.episode_strips(ftx(self.ft).ownerDocument, "one")
+        board = fountainhead.Stripboard(strips)
+        assert [s["scene"] for s in board.select(setting="ext", location="Docks", tod="NIGHT")] == [2, 3]
+        assert board.select(location="DOCKS", tod="DAY") == []
+        assert [(values, len(strips)) for (values, strips) in board.groups("setting", "tod")] == [
+            ((u"EXT", u"NIGHT"), 2), ((u"INT", u"DAY"), 1)]
+
+class TestStats:
+    ft = """Brick waits.
+
+INT. HOUSE - DAY #house#
+
+The door opens.
+
+MARY (V.O.)
+Where is it?
+
+TOM
+(quietly)
+Nowhere, I said.
+
+EXT. STREET - NIGHT
+
+MARY (CONT'D)
+Stop!
+"""
+    def test_report(self, tmpdir):
+        f = tmpdir.join("one.fountain")
+        f.write(self.ft)
+        args = fountainhead.stats_arg_parser().parse_args([str(f)])
+        [report] = fountainhead.corpus_stats(args.paths, args)
+        assert (report["scenes"], report["action_words"], report["dialogue_words"]) == (2, 5, 7)
+        assert report["settings"] == {"INT": 1, "EXT": 1}
+        assert report["tods"] == {"DAY": 1, "NIGHT": 1}
+        assert [(c["name"], c["speeches"], c["words"]) for c in report["characters"]] == \
+            [("MARY", 2, 4), ("TOM", 1, 3)]
+        assert [(s["scene"], s["id"], s["action_words"], s["dialogue_words"]) for s in report["scene_words"]] == \
+            [(0, None, 2, 0), (1, "house", 3, 6), (2, None, 0, 1)]
+        assert (report["pages"], report["runtime_minutes"]) == (0.25, 0.3)
+    def test_corpus(self, tmpdir):
+        tmpdir.join("one.fountain").write(self.ft)
+        tmpdir.join("two.fountain").write("INT. DOCKS - NIGHT\n\nTOM\nAgain.\n")
+        paths = [str(tmpdir.join("one.fountain")), str(tmpdir.join("two.fountain"))]
+        args = fountainhead.stats_arg_parser().parse_args(paths)
+        total = fountainhead.corpus_stats(paths, args)[-1]
+        assert total["script"] is None and "scene_words" not in total
+        assert total["settings"] == {"INT": 2, "EXT": 1}
+        assert total["tods"] == {"DAY": 1, "NIGHT": 2}
+        assert [(c["name"], c["words"], c["dialogue_share"]) for c in total["characters"]] == \
+            [("MARY", 4, 0.5), ("TOM", 4, 0.5)]
+        out = io.BytesIO()
+        fountainhead.write_stats_csv(fountainhead.corpus_stats(paths, args), out)
+        assert ",settings,INT,2" in out.getvalue().splitlines()
+
+class TestSidecar:
+    ft = """# ACT I #act1#
+
+INT. HOUSE - DAY #house#
+
+Mary sits. [[a note]]
+
+## Later
+
+EXT. STREET - NIGHT
+
+Tom & Mary run.
+
+# ACT II
+"""
+    def write(self, tmpdir, pretty):
+        offsets = []
+        doc = fountainhead.parse_fountain(io.BytesIO(self.ft), DEFAULT_ARGS)
+        with open(str(tmpdir.join("script.ftx")), "wb") as out:
+            size = fountainhead.write_ftx(doc, out, pretty, offsets)
+        with open(str(tmpdir.join("script.ftx.idx")), "w") as out:
+            fountainhead.write_sidecar(offsets, size, out)
+        return doc
+    @pytest.mark.parametrize("pretty", [False, True])
+    def test_units(self, tmpdir, pretty):
+        doc = self.write(tmpdir, pretty)
+        index = fountainhead.FtxIndex(str(tmpdir.join("script.ftx")))
+        for unit in ("scene", "section"):
+            for (n, e) in enumerate(doc.getElementsByTagName(unit), 1):
+                # pretty output indents inside units
+                assert re.sub(r">\s+<", "><", index.xml(unit, n)) == fountainhead.serialize(e)
+        assert index.scene("house").getElementsByTagName("note")[0].firstChild.data == "a note"
+        assert index.xml("section", "act1").startswith('<section heading="ACT I" id="act1">')
+        assert index.xml("section", 3) == '<section heading="ACT II"/>'
+        with pytest.raises(KeyError):
+            index.scene(3)
+        with pytest.raises(KeyError):
+            index.scene("nowhere")
+        index.close()
+    def test_stale(self, tmpdir):
+        self.write(tmpdir, False)
+        tmpdir.join("script.ftx").write("\n", mode="a")
+        with pytest.raises(ValueError):
+            fountainhead.FtxIndex(str(tmpdir.join("script.ftx")))
+
+class TestBuild:
+    def build(self, tmpdir, capsys, *sources):
+        argv = ["-x", "--no-check", "-t", "ftx,plot-summary", "--state", str(tmpdir.join("state.json"))]
+        fountainhead.build_main(argv+[str(tmpdir.join(s)) for s in sources])
+        return sorted(os.path.basename(l.split(" ", 1)[1]) for l in capsys.readouterr()[0].splitlines())
+    def test_incremental(self, tmpdir, capsys):
+        tmpdir.join("scene.fountain").write("INT. HOUSE - DAY #house#\n\nMary sits.\n")
+        tmpdir.join("script.fountain").write("Title: Brick\n\n# ACT I\n\n= Mary waits.\n\n=<scene.fountain\n")
+        tmpdir.join("other.fountain").write("EXT. STREET - NIGHT\n\nTom runs.\n")
+        assert self.build(tmpdir, capsys, "script.fountain", "other.fountain") == [
+            "other.ftx", "other.plot-summary", "script.ftx", "script.plot-summary"]
+        assert self.build(tmpdir, capsys, "script.fountain", "other.fountain") == []
+        # includes count, and targets that aren't what was built
+        tmpdir.join("scene.fountain").write("INT. HOUSE - DAY #house#\n\nMary stands.\n")
+        tmpdir.join("other.plot-summary").remove()
+        assert self.build(tmpdir, capsys, "script.fountain", "other.fountain") == [
+            "other.plot-summary", "script.ftx", "script.plot-summary"]
+        args = fountainhead.arg_parser().parse_args(["-x", str(tmpdir.join("script.fountain"))])
+        assert tmpdir.join("script.plot-summary").read() == fountainhead.plot_summary(args.infile, args)
+        assert "Mary stands." in tmpdir.join("script.ftx").read()
+    def test_failure(self, tmpdir, capsys):
+        tmpdir.join("script.fountain").write("Mary sits.\n")
+        with pytest.raises(SystemExit):
+            fountainhead.build_main(["-t", "pdf", "--weasyprint", "false", "--no-check",
+                                     "--state", str(tmpdir.join("state.json")), str(tmpdir.join("script.fountain"))])
+        assert not tmpdir.join("script.pdf").check()
+
+class TestDatabase:
+    ft = """Title: Brick & Steel
+
+# ACT I #act1#
+
+INT. HOUSE - DAY #house#
+
+Mary holds a [revolver](prop "gun").
+
+MARY (O.S.)
+(quietly)
+Where is it? [[check this]]
+Tell me.
+
+TOM ^
+Nowhere.
+"""
+    def write(self, tmpdir, ft):
+        f = tmpdir.join("script.fountain")
+        f.write(ft)
+        args = fountainhead.arg_parser().parse_args(["-x", str(f)])
+        return fountainhead.write_database(str(tmpdir.join("out.db")), str(f), args)
+    def query(self, tmpdir, sql):
+        return fountainhead.sqlite3.connect(str(tmpdir.join("out.db"))).execute(sql).fetchall()
+    def test_tables(self, tmpdir):
+        assert self.write(tmpdir, self.ft)
+        assert self.query(tmpdir, "SELECT title FROM scripts") == [("Brick & Steel",)]
+        assert self.query(tmpdir, "SELECT section, parent, id, heading FROM sections") == [(1, None, "act1", "ACT I")]
+        assert self.query(tmpdir, "SELECT scene, section, id, setting, location, tod FROM scenes") == [
+            (1, 1, "house", "INT.", "HOUSE", "DAY")]
+        assert self.query(tmpdir, "SELECT name, extension, parenthetical, dual, text FROM dialogue"
+                                  " NATURAL JOIN characters ORDER BY line") == [
+            ("MARY", "(O.S.)", "(quietly)", 1, "Where is it? \nTell me."),
+            ("TOM", None, None, 1, "Nowhere.")]
+        assert self.query(tmpdir, "SELECT scene, class, idref, text FROM breakdown") == [(1, "prop", "gun", "revolver")]
+        assert self.query(tmpdir, "SELECT scene, text FROM notes") == [(1, "check this")]
+        assert ("dialogue_character",) in self.query(tmpdir, "SELECT name FROM sqlite_master WHERE type='index'")
+    def test_replace(self, tmpdir):
+        assert self.write(tmpdir, self.ft)
+        assert not self.write(tmpdir, self.ft)
+        assert self.write(tmpdir, self.ft.replace("Nowhere.", "Nowhere.\nReally."))
+        assert self.query(tmpdir, "SELECT COUNT(*) FROM scripts") == [(1,)]
+        assert self.query(tmpdir, "SELECT text FROM dialogue WHERE line=2") == [("Nowhere.\nReally.",)]
+        assert self.query(tmpdir, "SELECT COUNT(*) FROM breakdown") == [(1,)]
+
+def reference_classify_line(line, nextline, last_tag, last_empty, syntax_extensions):
+    # classify_line() as it was before classification precomputed
+    # anything, to check classify_lines() against
+    sline = line.strip()
+    if line.lstrip().startswith("!"):
+        return fountainhead.ACTION, line.lstrip()[1:], None
+    if sline.startswith("#"):
+        _,marker,text=re.split(r"(#{1,6})", sline, maxsplit=1)
+        return fountainhead.SECTION_HEADING, text.strip(), len(marker)
+    if re.match(r"^===+$", sline):
+        return fountainhead.PAGE_BREAK, "", None
+    if syntax_extensions:
+        if sline.startswith("=<"):
+            return fountainhead.INCLUDE, sline[2:], None
+    if sline.startswith("="):
+        return fountainhead.SYNOPSIS, sline[1:].lstrip(), None
+    if last_empty:
+        if not nextline:
+            token = re.split(r"[\. ]", sline+" ")[0].upper()
+            if token in ("INT", "EXT", "EST", "INT/EXT", "I/E"):
+                return (fountainhead.SCENE_HEADING,
+                        sline[len(token)+1:].lstrip(),
+                        sline[:len(token)+1].rstrip())
+            if sline.startswith(".") and not sline.startswith(".."):
+                return fountainhead.SCENE_HEADING, sline[1:].lstrip(), None
+            if line.upper()==line:
+                if line.endswith("TO:"):
+                    return fountainhead.TRANSITION, sline, None
+            if sline.startswith(">") and not sline.endswith("<"):
+                return fountainhead.TRANSITION, sline[1:].lstrip(), None
+    if last_empty:
+        if nextline:
+            if line.upper()==line:
+                if re.sub(r"[0-9_]", "", re.sub(r"\W", "", line, flags=re.U)):
+                    return fountainhead.CHARACTER, sline, None
+            if sline.startswith("@"):
+                return fountainhead.CHARACTER, sline[1:].lstrip(), None
+    if line and last_tag in fountainhead.DIALOGUE_CONTEXT:
+        if re.match(r"^\(.*\)$", sline):
+            return fountainhead.PARENTHETICAL, sline, None
+        else:
+            return fountainhead.DIALOGUE, sline, None
+    return fountainhead.ACTION, line, None
+
+class TestClassification:
+    tricky = [u"INT. HOUSE", u"int house", u"I/E", u"EST.", u"INT./EXT. CAR", u"INTERIOR", u"\u0131nt. X",
+              u"CUT TO:", u"cut to:", u"R2D2", u"23", u"_", u"\u00c9COLE", u"(beat)", u"()", u"(", u" (x) ",
+              u"!INT. HOUSE", u"# act", u"###", u"===", u"=< f.fountain", u"= synopsis", u"@mary",
+              u"> FADE OUT", u"> THE END <", u".SCENE", u"...and", u"  MARY  ", u"Tom runs."]
+    @pytest.mark.parametrize("syntax_extensions", [False, True])
+    def test_same_as_reference(self, syntax_extensions):
+        scripts = []
+        for f in glob.glob(os.path.join(DIR, "tests/*.fountain")):
+            with open(f) as ft:
+                scripts.append(fountainhead.decode_lines(ft.readlines()))
+        for t in self.tricky:
+            scripts += [[u"", t, u""], [u"", t, u"x"], [u"", t], [u"MARY", t], [u"", u"MARY", t, u""]]
+        for lines in scripts:
+            last_tag, last_empty = None, True
+            expected = []
+            for (n, l) in enumerate(lines):
+                tag, text, extra = reference_classify_line(l, lines[n+1] if n+1 < len(lines) else None,
+                                                           last_tag, last_empty, syntax_extensions)
+                expected.append((tag, text, extra))
+                last_tag, last_empty = tag, tag in fountainhead.EMPTY_LINE_AFTER or not text
+            assert list(fountainhead.classify_lines(lines, syntax_extensions)) == expected
+    def test_lookahead(self):
+        assert [tag for (tag, _, _) in fountainhead.classify_lines([u"", u"EXT. STREET", u""], False)] == \
+            ["action", "scene-heading", "action"]
+        assert [tag for (tag, _, _) in fountainhead.classify_lines([u"", u"EXT. STREET", u"Tom runs."], False)] == \
+            ["action", "character", "line"]
+        # the end of input counts as an empty line
+        assert [tag for (tag, _, _) in fountainhead.classify_lines([u"", u"CUT TO:"], False)] == \
+            ["action", "transition"]
+
+class TestParallel:
+    ft = "".join("""
+# ACT %d #act%d#
+
+INT. HOUSE - DAY
+
+Mary sits. [[note %d]]
+
+MARY
+(quietly)
+Where *is* it?
+
+EXT. STREET - NIGHT
+
+/* boneyard
+
+INT. NOT A SCENE - DAY
+
+*/
+Tom runs.
+""" % (n, n, n) for n in range(100))
+    def serialize(self, ft, argv):
+        out = io.BytesIO()
+        args = fountainhead.arg_parser().parse_args(argv)
+        fountainhead.write_ftx(fountainhead.parse_fountain(io.BytesIO(ft), args), out)
+        return out.getvalue()
+    @pytest.mark.parametrize("argv", [[], ["-s"], ["-x", "-d"], ["-x", "-d", "-P"]])
+    def test_same_as_serial(self, argv):
+        assert self.serialize(self.ft, argv+["-j", "3"]) == self.serialize(self.ft, argv)
+    @pytest.mark.parametrize("f", glob.glob(os.path.join(DIR, "tests/*.fountain")))
+    def test_samples(self, f):
+        with open(f) as ft:
+            ft = ft.read()
+        assert self.serialize(ft, ["-x", "-d", "-j", "2", f]) == self.serialize(ft, ["-x", "-d", f])
+
+class TestPreview:
+    ft = """
+# ACT I
+
+INT. HOUSE - DAY
+
+Mary sits.
+
+EXT. STREET - NIGHT
+
+Tom runs.
+"""
+    @pytest.mark.parametrize("f", glob.glob(os.path.join(DIR, "tests/*.fountain")))
+    @pytest.mark.parametrize("argv", [[], ["-s"], ["-x"], ["-x", "-d"]])
+    def test_same_as_parse_fountain(self, f, argv):
+        args = fountainhead.arg_parser().parse_args(argv+[f])
+        expected = fountainhead.pprint(fountainhead.parse_fountain(args.infile, args))
+        chunks = {}
+        for _ in range(2):
+            # the second time, from chunks parsed the first
+            old, chunks = chunks, {}
+            with open(f) as infile:
+                doc = fountainhead.parse_chunked(infile, fountainhead.updated_args(args, infile=infile),
+                                                 old, chunks)
+            assert fountainhead.pprint(doc) == expected
+    @pytest.mark.parametrize("ft", [
+        "INT. A\n\nHello.\n\nINT. A\n\nHello.\n\nINT. B\n",
+        "# ACT I\n\n### deep\n\nHello.\n\n### deep\n\nHello.\n"])
+    def test_repeated_chunks(self, ft):
+        args = fountainhead.arg_parser().parse_args(["-x", "-d"])
+        expected = fountainhead.pprint(fountainhead.parse_fountain(io.BytesIO(ft), args))
+        doc = fountainhead.parse_chunked(io.BytesIO(ft), args, {}, {})
+        assert fountainhead.pprint(doc) == expected
+    def preview(self, tmpdir):
+        f = tmpdir.join("script.fountain")
+        f.write(self.ft)
+        return fountainhead.Preview(str(f), fountainhead.preview_arg_parser().parse_args([str(f)]))
+    def edit(self, preview, ft):
+        with open(preview.filename, "w") as f:
+            f.write(ft)
+        # file systems may not notice changes within the same second
+        preview.mtimes[preview.filename] = None
+        assert preview.update()
+    def test_replace(self, tmpdir):
+        preview = self.preview(tmpdir)
+        assert not preview.update()
+        self.edit(preview, self.ft.replace("Tom runs.", "Tom walks."))
+        assert preview.version == 2
+        assert preview.ops == [{"op": "replace", "unit": 2,
+                                "xml": u"<scene><scene-heading><setting>EXT.</setting><location>STREET</location><tod>NIGHT</tod></scene-heading><action>Tom walks.</action></scene>"}]
+        # a change to a section replaces the section with its scenes
+        self.edit(preview, self.ft.replace("ACT I", "ACT ONE").replace("Tom runs.", "Tom walks."))
+        assert [(op["op"], op["unit"]) for op in preview.ops] == [("replace", 0)]
+    def test_document(self, tmpdir):
+        preview = self.preview(tmpdir)
+        self.edit(preview, "")
+        page = xml.dom.minidom.parseString(preview.document()[1])
+        assert [n.nodeName for n in page.documentElement.childNodes] == ["action", "script"]
+        assert page.documentElement.lastChild.getAttribute("data-version") == "2"
+        # the script is only in the page
+        assert not preview.doc.getElementsByTagName("script")
+    def test_reload(self, tmpdir):
+        preview = self.preview(tmpdir)
+        self.edit(preview, self.ft+"\nINT. CAR - NIGHT\n\nThey drive.\n")
+        assert preview.ops == [{"op": "reload"}]
+    def test_server(self, tmpdir):
+        preview = self.preview(tmpdir)
+        server = fountainhead.PreviewServer(("localhost", 0), preview)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = "http://localhost:%d/" % server.server_address[1]
+            page = xml.dom.minidom.parseString(urllib2.urlopen(url).read())
+            assert page.getElementsByTagName("scene")
+            assert page.getElementsByTagName("script")[0].getAttribute("data-version") == "1"
+            assert "EventSource" in urllib2.urlopen(url+"preview.js").read()
+            assert "fountain" in urllib2.urlopen(url+"ftx.css").read()
+            # nothing from outside the script's directory
+            tmpdir.dirpath().join(tmpdir.basename+".css").write("fountain {}")
+            with pytest.raises(urllib2.HTTPError):
+                urllib2.urlopen(url+"../"+tmpdir.basename+".css")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestIndex:
+    ft = """
+EXT. THE DOCKS - NIGHT
+
+Mary waits with a [gun](prop "revolver").
+
+MARY
+Where is the gun?
+
+INT. HOUSE - DAY #house#
+
+JOHN
+The gun is here.
+"""
+    def index(self, tmpdir, ft):
+        tmpdir.join("docks.fountain").write(ft)
+        args = fountainhead.arg_parser().parse_args(["-x"])
+        return fountainhead.index_scripts(str(tmpdir.join("index.db")),
+                                          [str(tmpdir.join("docks.fountain"))], args)
+    def search(self, tmpdir, words, **filters):
+        return [r[1:] for r in fountainhead.search_index(str(tmpdir.join("index.db")), words, **filters)]
+    def test_search(self, tmpdir):
+        self.index(tmpdir, self.ft)
+        assert self.search(tmpdir, ["gun"], character="mary", element="line", tod="NIGHT") == [
+            (1, None, "line", "MARY", "Where is the gun?")]
+        assert self.search(tmpdir, ["the", "GUN"], setting="int") == [
+            (2, "house", "line", "JOHN", "The gun is here.")]
+        assert self.search(tmpdir, ["revolver"], bd_class="prop") == [
+            (1, None, "bd", None, "gun")]
+        assert self.search(tmpdir, ["docks"], element="scene-heading") == [
+            (1, None, "scene-heading", None, "EXT. THE DOCKS NIGHT")]
+        assert self.search(tmpdir, ["knife"]) == []
+    def test_incremental(self, tmpdir):
+        assert len(self.index(tmpdir, self.ft)) == 1
+        assert self.index(tmpdir, self.ft) == []
+        assert len(self.index(tmpdir, self.ft.replace("gun?", "knife?"))) == 1
+        assert [r[-1] for r in self.search(tmpdir, ["gun"], element="line")] == ["The gun is here."]
+        # scripts that are gone drop out of the index
+        tmpdir.join("docks.fountain").remove()
+        fountainhead.index_scripts(str(tmpdir.join("index.db")), [], DEFAULT_ARGS)
+        assert self.search(tmpdir, ["gun"]) == []